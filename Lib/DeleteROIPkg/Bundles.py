@@ -24,9 +24,11 @@ import locale
 import os
 import re
 import shutil
+import threading
 import traceback
 
 from java.awt               import Color
+from java.util.concurrent   import Callable, CancellationException, ExecutionException
 from datetime               import datetime
 
 from ij                     import CompositeImage, IJ, WindowManager
@@ -39,6 +41,7 @@ from DeleteROIPkg.Utilities import close_all, trace, OPTIONS, NumberFormatter
 
 # Constants:
 field_delimiter   = "\t"        # Expected delimiter in TXT files
+PREFETCH_MEMORY   = 3           # Free memory needed to open an image in the background, as a multiple of its file size
 
 # Manager to handle all defined bundles    
 class BundleManager:
@@ -53,8 +56,9 @@ class BundleManager:
         self.bundles = []            # All defined bundles with internal ROi data
         self.number_formatter = None # Helper class to parse/emit numbers in the correct locality format
     
-    # Create a bundle to be processed
-    def create_bundle(self, image_path, roi_data_path, bundle_id=-1):
+    # Create a bundle to be processed.  When expected_roi_size is supplied (restoring from session state)
+    # the ROI data is only parsed once it is needed.
+    def create_bundle(self, image_path, roi_data_path, bundle_id=-1, expected_roi_size=None):
         #
         if (image_path is None):
             raise ValueError("Image path not specified")
@@ -72,7 +76,7 @@ class BundleManager:
             elif bundle_id > BundleManager.next_bundle_id:
                 BundleManager.next_bundle_id = bundle_id
                 
-            bundle = CiliaQBundle(bundle_id, image_path, roi_data_path)
+            bundle = CiliaQBundle(bundle_id, image_path, roi_data_path, expected_roi_size)
         
             # Add it to the save array
             self.bundles.append(bundle)
@@ -160,33 +164,16 @@ class BundleManager:
     def get_length(self):
         return len(self.bundles)
 
-    # Iterator to access available montages
+    # Iterator to access available bundles
     def __iter__(self):
-        # Iterator to iterate over entry indices
-        if self.bundles is None or len(self.bundles) == 0:
-            return None
-        
-        self._index = 0
-        return self
-
-    def __next__(self):
-        # Next method for iterator (python3)
-        if self._index < len(self.bundles):
-            result = self.bundles[self._index]
-            self._index += 1
-            return result
-        else:
-            raise StopIteration
-            
-    def next(self):
-        # Next method for iterator (python2)
-        return self.__next__()
+        #
+        return iter(self.bundles)
     
 class CiliaQBundle:
     #
     # This class is used to process an image/CiliaQ txt file generating the appropriate ROI information     
     #
-    def __init__(self, bid, image_path, roi_data_path):
+    def __init__(self, bid, image_path, roi_data_path, expected_roi_size=None):
         # 
         if not os.path.isfile(image_path):
             raise ValueError("Supplied image_path is not a file: "+str(image_path))
@@ -206,12 +193,20 @@ class CiliaQBundle:
         
         # Pointer to active images
         self.image         = None
+        self.image_future  = None   # Pending background open of the image (see prefetch_image)
+        self.image_claimed = False  # Set once process_image() has started, any later prefetch is ignored
+        self.image_lock    = threading.Lock()
         
         # Indicates if this bundle is enabled or not
         self.enabled       = True
         
-        # Process the ROI data at this point.  This is lightweight
-        self.roi_info      = self.process_roi(roi_data_path)
+        # Process the ROI data at this point.  This is lightweight, but when the expected size is known
+        # (restored from the session state) it is deferred until the ROI data is actually needed.
+        self.expected_roi_size = expected_roi_size
+        self.roi_info          = None
+        
+        if expected_roi_size is None:
+            self.roi_info = self.process_roi(roi_data_path)
 
     # Return the Bundle ID
     def get_id(self):
@@ -221,6 +216,17 @@ class CiliaQBundle:
     def get_roi_length(self):
         if self.roi_info is not None:
             return self.roi_info.get_data_len()
+        elif self.expected_roi_size is not None:
+            return self.expected_roi_size
+        else:
+            return 0
+    
+    # Return the number of parsed roi entries, the expected size is used while parsing is deferred
+    def get_roi_count(self):
+        if self.roi_info is not None:
+            return self.roi_info.get_roi_count()
+        elif self.expected_roi_size is not None:
+            return self.expected_roi_size
         else:
             return 0
     
@@ -258,6 +264,9 @@ class CiliaQBundle:
 
     # Return the underlying RoiInfo containing the ROI for this bundle
     def get_roi_info(self):
+        if self.roi_info is None and self.expected_roi_size is not None:
+            self.roi_info = self.process_roi(self.roi_data_path)
+            
         return self.roi_info
         
     # Returns the root for the slide we are assocated with, None if no slide
@@ -268,6 +277,29 @@ class CiliaQBundle:
         
         return None
     
+    # Start opening the image on the supplied executor, process() then uses the opened image rather than
+    # opening it again.  Only the open is done in the background, the processing relies on the UI.  The
+    # open is skipped when memory is short, the image is then opened when it is processed.
+    def prefetch_image(self, executor):
+        #
+        with self.image_lock:
+            if self.image is not None or self.image_future is not None or self.image_claimed:
+                return
+            
+            if not CiliaQBundle.has_memory_for(self.image_path):
+                trace("prefetch_image: insufficient memory, not prefetching: {}", self.image_path)
+                return
+                
+            self.image_future = executor.submit(CiliaQBundle.OpenImageTask(self.image_path))
+    
+    # Determine if there is enough free memory to open the image in the background
+    @staticmethod
+    def has_memory_for(image_path):
+        #
+        needed = os.path.getsize(image_path) * PREFETCH_MEMORY
+        
+        return IJ.maxMemory() - IJ.currentMemory() >= needed
+    
     # Process the image and generate the ROI data
     def process(self, debug=OPTIONS.debug):
         #
@@ -285,33 +317,45 @@ class CiliaQBundle:
             IJ.showMessage("Error processing TXT File", "Error while processing image: {} --> {}".format(self.get_image_filename(), result))
             return
 
-    # If there are changes to the ROI file, save them now
-    def save_changes(self, group_path, dry_run=False):
+    # If there are changes to the ROI file, save them now.  When reuse_plan is set the changes determined 
+    # by a prior dry_run are used rather than being recalculated.
+    def save_changes(self, group_path, dry_run=False, reuse_plan=False):
         if dry_run:
-            return self.roi_info.determine_changes(group_path)
+            return self.get_roi_info().determine_changes(group_path)
         else:
-            return self.roi_info.save_changes(group_path)
+            return self.get_roi_info().save_changes(group_path, reuse_plan)
 
     # Iterator to access available ROI entries
     def __iter__(self):
-        if self.roi_info is not None:
-            return self.roi_info.__iter__()
+        if self.get_roi_info() is not None:
+            return iter(self.roi_info)
         
-        return self
-
-    def __next__(self):
-        raise StopIteration
-            
-    def next(self):
-        return self.__next__()
+        return iter(())
     
     # Private methods - not meant to be called external to class
     
     # Function to open and process the image
     def process_image(self, image_path, show=False):
         #
-        # Open the primary image
-        image = IJ.openImage(image_path)
+        # Open the primary image, using the background open if one was started.  If that failed or was
+        # cancelled we simply open it now.
+        image  = None
+        future = None
+        
+        if image_path == self.image_path:
+            with self.image_lock:
+                future             = self.image_future
+                self.image_future  = None
+                self.image_claimed = True
+                
+        if future is not None:
+            try:
+                image = future.get()
+            except (CancellationException, ExecutionException) as e:
+                trace("process_image: background open failed, reopening: {}", e)
+            
+        if image is None:
+            image = IJ.openImage(image_path)
         image.hide()
         #
         # TODO: Edit LUT to change channel one 255 to Blue (0,0,255)
@@ -687,6 +731,19 @@ class CiliaQBundle:
         #
         return "bundle({}, {}, {})".format(self.get_image_filename(), self.get_roi_filename(), self.enabled)
 
+    # Helper class to open the image on an executor thread.  Opening does not involve any windows so it is
+    # safe to do in the background.
+    class OpenImageTask(Callable):
+        def __init__(self, image_path):
+            self.image_path = image_path
+        #
+        def call(self):
+            # Memory may have been used since the open was queued, if so leave it for process_image()
+            if not CiliaQBundle.has_memory_for(self.image_path):
+                return None
+            
+            return IJ.openImage(self.image_path)
+
 # Class to store the ROI information for a bundle
 class RoiInfo:
     #
@@ -705,6 +762,12 @@ class RoiInfo:
         
         # Initialize the entries list
         self.entries = []  # To store entries with item_id, x_value, y_value
+        
+        # Number of entries that are culled, maintained as entries are added/removed/culled
+        self.culled_count = 0
+        
+        # The ids being culled as calculated by the last determine_changes (dry run)
+        self.planned_skipped_ids = None
 
     # Save the metadata
     def set_metadata(self, row_count=None, header_len=None, history_len=None, data_len=None, calibration=None, file_name=None):
@@ -778,6 +841,9 @@ class RoiInfo:
         # Add a new entry with specified item_id, x_value, and y_value.
         self.entries.append(RoiInfo.RoiEntry(self, item_id, x_value, y_value, is_culled))
         
+        if is_culled:
+            self.culled_count += 1
+        
     # Getter method for values in an entry by index - really a private method, don't use
     def get_entry(self, index):
         # Retrieve entry at specified index.
@@ -814,18 +880,20 @@ class RoiInfo:
     def delete_entry(self, index):
         # Delete entry at specified index.
         if 0 <= index < len(self.entries):
+            if self.entries[index].isCulled():
+                self.culled_count -= 1
+                
             del self.entries[index]
         else:
             raise IndexError("Entry index out of range")
     
     # Method to return the count of culled entries
     def get_culled_count(self):
-        num_culled = 0
-        for entry in self.entries:
-            if entry.isCulled():
-                num_culled += 1
-                
-        return num_culled
+        return self.culled_count
+    
+    # Method to return the ids of the entries marked culled via the UI
+    def get_marked_culled_ids(self):
+        return [int(entry.item_id) for entry in self.entries if entry.isMarkedCulled()]
     
     # Method to return the number of roi entries
     def get_roi_count(self):
@@ -833,21 +901,8 @@ class RoiInfo:
 
     # Iterator to access available indices
     def __iter__(self):
-        # Iterator to iterate over entry indices.
-        self._index = 0
-        return self
-
-    def __next__(self):
-        # Next method for iterator.
-        if self._index < len(self.entries):
-            result = self.entries[self._index]
-            self._index += 1
-            return result
-        else:
-            raise StopIteration
-            
-    def next(self):
-        return self.__next__()
+        # Iterate directly over the entries list
+        return iter(self.entries)
     
     # If there are culled entries, write an updated ROI file minus the culled entries.  The results is a tuple
     # indicating:
@@ -861,13 +916,16 @@ class RoiInfo:
     #       --> The previous version of the -active prior to modification is stored here
     #       --> A copy of the -active stripped of everything except the active ROI information
     #
-    def save_changes(self, group_path):
+    def save_changes(self, group_path, reuse_plan=False):
         #
         bundle_id    = self.bundle.bundle_id
         image_name   = self.bundle.get_image_filename()
         formatter    = self.bundle.num_formatter
         result       = False
-        skipped_ids   = [int(id.item_id) for id in self.entries if id.isMarkedCulled()]       
+        skipped_ids  = self.planned_skipped_ids if reuse_plan else None
+        if skipped_ids is None:
+            skipped_ids = self.get_marked_culled_ids()
+        self.planned_skipped_ids = None
         slide_id     = self.bundle.slide.slide_id if self.bundle.slide else "-"
         errors       = []
         messages     = []
@@ -1024,8 +1082,9 @@ class RoiInfo:
         no_changes  = []
         
         try:
-            # Determine the id's that are being skipped for this session
-            skipped_ids = [int(id.item_id) for id in self.entries if id.isMarkedCulled()]
+            # Determine the id's that are being skipped for this session, remember them for save_changes
+            skipped_ids = self.get_marked_culled_ids()
+            self.planned_skipped_ids = skipped_ids
             
             # If we have no elements to cull, do nothing.
             if len(skipped_ids) == 0:
@@ -1105,6 +1164,10 @@ class RoiInfo:
             return self.is_culled
             
         def setCulled(self, status=True):
+            # Keep the culled count of the RoiInfo in step
+            if bool(status) != bool(self.is_culled):
+                self.roi_info.culled_count += 1 if status else -1
+                
             self.is_culled = status
             
         #
@@ -20,20 +20,20 @@
  * ===============================================================================
 '''
 
-import fnmatch
-import math
 import random
-import re
 import threading
 
-from java.awt               import BorderLayout, Color, FlowLayout, Font, GridBagLayout, GridBagConstraints
+from java.awt               import BorderLayout, Color, FlowLayout, Font, GridBagLayout, GridBagConstraints, Rectangle
 from java.awt.event         import ActionListener, MouseAdapter, InputEvent, WindowAdapter
+from java.lang              import System
+from java.util.concurrent   import Callable, Executors
 from javax.swing            import JButton, JFrame, JPanel, JTextArea
 
 from ij                     import IJ
 from ij.gui                 import ImageCanvas
 from ij.plugin.frame        import RoiManager
 from ij.plugin              import MontageMaker, Zoom
+from ij.process             import ColorProcessor, ImageProcessor
 
 
 # GUI Imports
@@ -44,13 +44,48 @@ from DeleteROIPkg.Bundles   import RoiInfo
 from DeleteROIPkg.Dialogs   import COLOR_LABEL, FONT_MONO
 from DeleteROIPkg.Utilities import close_all, parm_screen_width, trace, OPTIONS
 
+# The layout of the montages is fixed for a session (columns, cell size, border and scale) so the
+# geometry is computed once by the MontageManager and shared by each of its Montage objects.
+class MontageGeometry:
+    #
+    def __init__(self, columns, max_rows, cell_height, cell_width, border_width, scale):
+        #
+        self.columns      = int(columns)
+        self.max_rows     = int(max_rows)
+        self.cell_height  = int(cell_height)
+        self.cell_width   = int(cell_width)
+        self.border_width = int(border_width)
+        self.scale        = scale
+        
+        # Offset from the ROI center to the top left corner of the ROI
+        self.cw2          = self.cell_width  >> 1
+        self.ch2          = self.cell_height >> 1
+        
+        # Size of a cell as displayed and the distance between cells (includes the border)
+        self.mcell_height = int(self.cell_height * scale)
+        self.mcell_width  = int(self.cell_width  * scale)
+        self.pitch_x      = self.mcell_width  + self.border_width
+        self.pitch_y      = self.mcell_height + self.border_width
+        
+        # Starting x/y of each column/row, the last entry is the total width/height of a full montage
+        self.col_x        = [i * self.pitch_x for i in range(self.columns  + 1)]
+        self.row_y        = [j * self.pitch_y for j in range(self.max_rows + 1)]
+        
+    # Overload the str() function to print something useful
+    def __repr__(self):
+        #
+        return "MontageGeometry(columns={}, max_rows={}, cell={}x{}, border={}, scale={})".format(self.columns, self.max_rows,
+                    self.cell_width, self.cell_height, self.border_width, self.scale)
+
 class MontageManager:
     #
     # Creates and manages the montage to be processed
     #
-    def __init__(self, session_id, columns=5, rows=10, roi_size=64, border_width=4):
+    def __init__(self, session_id, columns=5, rows=10, roi_size=64, border_width=4, parallelism=None):
         #
         self.session_id   = session_id
+        self.parallelism  = parallelism if parallelism else OPTIONS.getNumThreads()
+        self.pool         = None          # Thread pool shared by the montages, created when first needed
         
         # Originally the ROI bounding box could have different width/height (i.e., not be a square). 
         self.cell_height  = roi_size
@@ -65,6 +100,9 @@ class MontageManager:
         # Now we need to determine practical maximums
         self.screen_height, self.screen_width, self.m_columns, self.max_rows = \
             self.determine_screen_size(self.cell_height, self.cell_width, columns, rows, border_width)
+        
+        # The layout is the same for every montage in the session, compute it once and share it
+        self.geom = MontageGeometry(self.m_columns, self.max_rows, self.cell_height, self.cell_width, border_width, OPTIONS.scale)
     
     # Add a bundle to be processed
     def add_bundle(self, bundle):
@@ -74,6 +112,14 @@ class MontageManager:
             
         self.bundles.append(bundle)
         
+    # Add a list of bundles to be processed in a single call
+    def add_bundles(self, bundles):
+        #
+        if any(bundle is None for bundle in bundles):
+            raise ValueError("Bundle not specified")
+            
+        self.bundles.extend(bundles)
+        
     # Lock the bundles, this causes the creation of the random order used in showing the
     # montages to the user.
     def lock_bundles(self, debug=OPTIONS.debug):
@@ -94,18 +140,19 @@ class MontageManager:
         # Now create the random_b structure containing the random items across the bundles
         total_entries = 0
         for bundle in self.bundles:
-            if bundle.is_enabled():
-                total_entries += bundle.get_roi_length()
+            if bundle.get_roi_info() is not None:
+                total_entries += bundle.get_roi_info().get_roi_count()
         
         # Save up all ROI entries into an array so that we can populate the montage(s)
-        roi_entries = []
+        roi_entries = [None] * total_entries
+        index       = 0
         for bundle in self.bundles:
             for entry in bundle:
-                roi_entries.append(entry)
+                roi_entries[index] = entry
+                index += 1
        
-        # Now randomize this list for processing
-        for i in range(len(roi_entries)):
-            random.shuffle(roi_entries)
+        # Now randomize this list for processing, a single shuffle gives a uniformly random order
+        random.shuffle(roi_entries)
         self.random_roi = roi_entries
         
     # Process the montage.  We have a set of bundles each representating an image and the associated ROI.
@@ -131,6 +178,13 @@ class MontageManager:
         num_roi_proc       = 0
         montage_id         = 0
         
+        # Determine how many montages we need so they can be allocated up front
+        num_entries = 0
+        for entry in self.random_roi:
+            if not entry.isCulled():
+                num_entries += 1
+        self.montages = [None] * ((num_entries + images_per_montage - 1) // images_per_montage)
+        
         # Process the random_roi
         for entry in self.random_roi:
             #
@@ -139,10 +193,10 @@ class MontageManager:
             
             if curr_montage is None:
                 montage_id += 1
-                curr_montage = MontageManager.Montage(self, montage_id, self.session_id, self.m_columns, self.cell_height, self.cell_width, self.border_width)
-                self.montages.append(curr_montage)
+                curr_montage = MontageManager.Montage(self, montage_id, self.session_id, self.geom)
+                self.montages[montage_id - 1] = curr_montage
             
-            trace("create_montage: images_per_montage={}, entry={}, num_roi_proc={}".format(images_per_montage, entry, num_roi_proc))
+            trace("create_montage: images_per_montage={}, entry={}, num_roi_proc={}", images_per_montage, entry, num_roi_proc)
             
             # Add the entry to the montage.  They are already randomized so this is straight forward
             curr_montage.add_entry(entry)
@@ -150,7 +204,7 @@ class MontageManager:
             
             # Ensure we don't add more ROI then permitted
             if num_roi_proc >= images_per_montage:
-                trace("Current montage full: {}".format(curr_montage.get_num_entries()))
+                trace("Current montage full: {}", curr_montage.get_num_entries())
                 num_roi_proc = 0
                 curr_montage = None
 
@@ -166,8 +220,10 @@ class MontageManager:
         screen_width  = dimension.width
         
         # Determine how many rows we can accomodate given the screen height & width
-        cols = int((screen_width  - 100) / ((cell_width  * OPTIONS.scale) + border_width))
-        rows = int((screen_height - 200) / ((cell_height * OPTIONS.scale) + border_width))
+        # Everything here is integral (OPTIONS.setScale() stores an int) so use floor division
+        scale = int(OPTIONS.scale)
+        cols  = (screen_width  - 100) // ((cell_width  * scale) + border_width)
+        rows  = (screen_height - 200) // ((cell_height * scale) + border_width)
         
         if cols < max_columns:
             max_columns = cols
@@ -182,6 +238,20 @@ class MontageManager:
     def get_num_montages(self):
         #
         return len(self.montages)
+    
+    # Retrieve the thread pool used to extract the montage cells, all montages of the session share it
+    def get_pool(self):
+        #
+        if self.pool is None:
+            self.pool = Executors.newFixedThreadPool(self.parallelism)
+        return self.pool
+    
+    # Release the thread pool, must be called once the montages are no longer being created
+    def shutdown(self):
+        #
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
 
     # Iterator to access available montages
     def __iter__(self):
@@ -189,21 +259,7 @@ class MontageManager:
         if self.montages is None or len(self.montages) == 0:
             raise KeyError("Failed to call create_montage - no montages available")
         
-        self._index = 0
-        return self
-
-    def __next__(self):
-        # Next method for iterator (python3)
-        if self._index < len(self.montages):
-            result = self.montages[self._index]
-            self._index += 1
-            return result
-        else:
-            raise StopIteration
-            
-    def next(self):
-        # Next method for iterator (python2)
-        return self.__next__()
+        return iter(self.montages)
     
     #
     # Helper class to manage an instance of a montage
@@ -216,15 +272,16 @@ class MontageManager:
         rightButton   = 4;      # same
         
         # Constructor
-        def __init__(self, montage_mgr, montage_id, session_id, columns=5, cell_height=64, cell_width=64, border_width=4):
+        def __init__(self, montage_mgr, montage_id, session_id, geom):
             #
             self.montage_mgr  = montage_mgr
             self.montage_id   = montage_id
             self.session_id   = session_id
-            self.border_width = int(border_width)
-            self.cell_height  = int(cell_height)
-            self.cell_width   = int(cell_width)
-            self.m_columns    = int(columns)
+            self.geom         = geom
+            self.border_width = geom.border_width
+            self.cell_height  = geom.cell_height
+            self.cell_width   = geom.cell_width
+            self.m_columns    = geom.columns
             #
             # To be computed
             self.m_rows       = -1
@@ -251,16 +308,16 @@ class MontageManager:
             self.roi_entries.append(roi_entry)
         
             # Compute the montage dimensions.
-            self.m_rows = int(math.ceil(float(len(self.roi_entries)) / float(self.m_columns)))
+            self.m_rows = (len(self.roi_entries) + self.m_columns - 1) // self.m_columns
             
-            trace("add_entry({}, {}, {})".format(len(self.roi_entries), self.m_columns, self.m_rows))
+            trace("add_entry({}, {}, {})", len(self.roi_entries), self.m_columns, self.m_rows)
 
         # Returns the number of ROI entries currently defined
         def get_num_entries(self):
             return len(self.roi_entries)
         
-        # Process all of the added entries creating a montage
-        def process_montage(self, scale=1.0):
+        # Process all of the added entries creating a montage.  The scale is fixed by the MontageGeometry.
+        def process_montage(self):
             #
             self.isCancelled(False)
             
@@ -268,7 +325,7 @@ class MontageManager:
             self.condition  = threading.Condition()  # Create a condition variable for blocking
             self.txt_font   = Font("Calibri", Font.PLAIN, 16)
 
-            self.m_image    = self.create_montage(scale)
+            self.m_image    = self.create_montage()
             self.m_image.setOverlay(Overlay())
 
             self.m_canvas   = ImageCanvas(self.m_image)
@@ -367,7 +424,7 @@ class MontageManager:
                 raise UserWarning("Cancel")
             
         # Create the montage for this entry
-        def create_montage(self, scale=1.0):
+        def create_montage(self):
             #
             # The roi_entries structure is used to display the montage in order provided.
             roiManager = RoiManager.getInstance()
@@ -377,77 +434,76 @@ class MontageManager:
             
             # local variables
             num_roi_entries   = len(self.roi_entries)
-            roi_index         = 0
             stack_title       = "ROIs Stack_" + str(self.montage_id)
             slice_index       = 0
             
             # Computed variables
-            self.mcell_height = int(self.cell_height * scale)
-            self.mcell_width  = int(self.cell_width * scale)
-            self.m_height     = int((self.mcell_height + self.border_width) * self.m_rows)
-            self.m_width      = int((self.mcell_width  + self.border_width) * self.m_columns)
+            geom              = self.geom
+            self.m_height     = geom.row_y[self.m_rows]
+            self.m_width      = geom.col_x[self.m_columns]
             
             # Create an empty stack for the montage
-            IJ.newImage(stack_title, "RGB", self.mcell_width, self.mcell_height, num_roi_entries + 1);  # Create a stack to hold all the ROIs
+            IJ.newImage(stack_title, "RGB", geom.mcell_width, geom.mcell_height, num_roi_entries + 1);  # Create a stack to hold all the ROIs
             stack = IJ.getImage();
             stack.hide()
             
-            trace(" roi_entries="+str(self.roi_entries))
+            trace(" roi_entries={}", self.roi_entries)
+
+            # Set the visibility of each source image once rather than for every ROI taken from it
+            seen_images = set()
+            for entry in self.roi_entries:
+                image = entry.get_roi_info().get_bundle().image
+                if id(image) in seen_images:
+                    continue
+                seen_images.add(id(image))
+                
+                if OPTIONS.debug:
+                    image.show()
+                else:
+                    image.hide()
 
-            # Process the ROI info creating ROI entries as appropriate
+            # Process the ROI info creating ROI entries as appropriate.  The RoiManager is not thread safe so
+            # the ROI are registered here while the pixel extraction of each cell is queued for the pool.
+            tasks = []
             for entry in self.roi_entries:
             
                 # Retrieve the current value
                 bundle        = entry.get_roi_info().get_bundle()
                 calibration   = entry.get_roi_info().calibration
                 item_id       = entry.item_id
-                item_x_center = int(entry.x_value * calibration) - int(self.cell_width/2)
-                item_y_center = int(entry.y_value * calibration) - int(self.cell_height/2)
+                item_x_center = int(entry.x_value * calibration) - geom.cw2
+                item_y_center = int(entry.y_value * calibration) - geom.ch2
                 roi_name      = "{}-{}".format(bundle.bundle_id, item_id)
                 
-                trace("image_id: {}, BID: {}, ID: {}, x={}, y={}".format(bundle.image.getID(), bundle.bundle_id, item_id, item_x_center, item_y_center))
-        
-                # Indicate which slice we are working on
-                slice_index += 1
+                trace("image_id: {}, BID: {}, ID: {}, x={}, y={}", bundle.image.getID(), bundle.bundle_id, item_id, item_x_center, item_y_center)
 
-                # Set the ROI to the defined rectangle (centered at x, y) and add it to the RoiManager
+                # Set the ROI to the defined rectangle (centered at x, y) and add it to the RoiManager.  The
+                # ROI is named before it is added so the list is only updated once rather than again by rename().
                 image = bundle.image
-                trace("create_montage(title={})".format(image.getTitle()))
-                if OPTIONS.debug:
-                    image.show()
-                else:
-                    image.hide()
+                trace("create_montage(title={})", image.getTitle())
                 image.setRoi(item_x_center, item_y_center, self.cell_width, self.cell_height);
-                roiManager.add(image, image.getRoi(), -1)
-                roiManager.rename(roi_index, roi_name)
-            
-                # Create a new image to hold the ROI extraction
-                img_dup = image.duplicate()
-                img_dup.hide()
-                img_dup.setRoi(item_x_center, item_y_center, self.cell_width, self.cell_height);
                 roi = image.getRoi()
                 roi.setName(roi_name)
-                img_dup.setTitle("title=ROIExtracted_" + item_id)
-            
-                # Resize the cropped image to requested pixels
-                img_resize = img_dup.resize(self.mcell_width, self.mcell_height, "bilinear")
-                img_resize.copy()
-                
-                # Paste the extracted image into the stack
-                stack.setSlice(slice_index)    # Set the current slice to the i-th position
-                stack.paste()
-            
-                # Close the extracted ROI image to keep things clean
-                img_dup.close()
-                img_resize.close()
+                roiManager.add(image, roi, -1)
                 
-                # The next roi slot to use
-                roi_index += 1
-
-            # There is an issue in which the last image pasted does not show up unless the montage is visible.  I suspect
-            # it's around the image being updated on the screen.  As a workaround change the slice to finish the paste.  There is
-            # likely a better way of forcing the window to update but this does work.
-            stack.setSlice(slice_index+1)    # Set the current slice to the i-th position
+                # Queue the extraction of the cell from the source image
+                tasks.append(MontageManager.Montage.ExtractCellTask(image.getProcessor(), item_x_center, item_y_center,
+                                                                    self.cell_width, self.cell_height, geom.mcell_width, geom.mcell_height))
+
+            # Extract and resize the cells in parallel, each one only reads from its source image
+            futures = self.montage_mgr.get_pool().invokeAll(tasks)
+            
+            # Now insert the extracted cells into the stack, slices are numbered from one.  An RGB cell fills the
+            # whole slice so its pixels are copied in one block, anything else is converted by insert().
+            cells      = stack.getStack()
+            slice_size = geom.mcell_width * geom.mcell_height
+            for future in futures:
+                slice_index += 1
+                cell = future.get()
+                if isinstance(cell, ColorProcessor) and cell.getPixelCount() == slice_size:
+                    System.arraycopy(cell.getPixels(), 0, cells.getPixels(slice_index), 0, slice_size)
+                else:
+                    cells.getProcessor(slice_index).insert(cell, 0, 0)
             
             # At this point we have a stack of images ready to be used for the montage
             IJ.setBackgroundColor(0, 0, 0)  # Set the background color to black
@@ -470,19 +526,20 @@ class MontageManager:
             overlay = self.get_image_overlay(self.m_canvas, True)
             #
             num_cells      = len(self.roi_entries)
+            geom           = self.geom
             
             trace("draw grid: rows={}, num_cells={}".format(self.m_rows, num_cells))
             #
             for i in range(1, self.m_columns):
-                x = i * (self.mcell_width + self.border_width)
-                trace("draw_grid({}, {}, {})".format(i, ((self.m_rows - 1) * self.m_columns) + i, num_cells))
+                x = geom.col_x[i]
+                trace("draw_grid({}, {}, {})", i, ((self.m_rows - 1) * self.m_columns) + i, num_cells)
                 if ((self.m_rows - 1) * self.m_columns) + i > num_cells:
-                    line = Line(x, 0, x, self.m_height - self.mcell_height)
+                    line = Line(x, 0, x, self.m_height - geom.mcell_height)
                 else:                    
                     line = Line(x, 0, x, self.m_height)
                 overlay.add(line)
             for j in range(1, self.m_rows):
-                y = j * (self.mcell_height + self.border_width)
+                y = geom.row_y[j]
                 line = Line(0, y, self.m_width, y)
                 overlay.add(line)
             #
@@ -515,14 +572,14 @@ class MontageManager:
                     entry     = self.roi_entries[index]
                     label     = "{}-{}".format(entry.roi_info.bundle.bundle_id, entry.item_id)
                     #
-                    row       = int(index / self.m_columns)
-                    column    = int((index % self.m_columns))
-                    x_value   = (self.mcell_height + self.border_width) * column
-                    y_value   = (self.mcell_height + self.border_width) * row
+                    row       = index // self.m_columns
+                    column    = index % self.m_columns
+                    x_value   = self.geom.col_x[column]
+                    y_value   = self.geom.row_y[row]
                     label_roi = TextRoi(x_value, y_value, label, FONT_MONO)
                     label_roi.setColor(COLOR_LABEL)
             
-                    trace("draw_labels: row={}, column={}, x={}, y={}, label={}".format(row, column, x_value, y_value, label))
+                    trace("draw_labels: row={}, column={}, x={}, y={}, label={}", row, column, x_value, y_value, label)
                     
                     # Now save the roi we created, we append growing the array, matching the index number
                     self.lbl_rois.append(label_roi)
@@ -553,11 +610,10 @@ class MontageManager:
         def add_x(self, row, column):
             #
             overlay     = self.get_image_overlay(self.m_canvas)
-            cell_height = self.mcell_height + self.border_width
-            cell_width  = self.mcell_width  + self.border_width
+            geom        = self.geom
             #
-            x1, y1 = (column - 1) * cell_height, (row - 1) * cell_height
-            x2, y2 = x1 + cell_width, y1 + cell_width
+            x1, y1 = geom.col_x[column - 1], geom.row_y[row - 1]
+            x2, y2 = x1 + geom.pitch_x, y1 + geom.pitch_y
             overlay.add(Line(x1, y1, x2, y2))   # Diagonal from top-left to bottom-right
             overlay.add(Line(x1, y2, x2, y1))   # Diagonal from bottom-left to top-right
         
@@ -604,6 +660,27 @@ class MontageManager:
             #
             return "montage({}, {})".format(self.montage_id, len(self.roi_entries))
 
+        # Helper class to extract a single cell from the source image and resize it for the montage.  This
+        # runs on the thread pool so it must not modify the source image (i.e., no setRoi()).
+        class ExtractCellTask(Callable):
+            def __init__(self, ip, x, y, width, height, cell_width, cell_height):
+                self.ip          = ip
+                self.bounds      = Rectangle(x, y, width, height)
+                self.cell_width  = cell_width
+                self.cell_height = cell_height
+            #
+            def call(self):
+                # Only the part of the ROI within the image is used, matching ImagePlus.resize()
+                src = self.bounds.intersection(Rectangle(0, 0, self.ip.getWidth(), self.ip.getHeight()))
+                if src.isEmpty():
+                    return self.ip.createProcessor(self.cell_width, self.cell_height)
+                
+                cell = self.ip.createProcessor(src.width, src.height)
+                cell.insert(self.ip, -src.x, -src.y)
+                cell.setInterpolationMethod(ImageProcessor.BILINEAR)
+                
+                return cell.resize(self.cell_width, self.cell_height)
+
         # Helper class to handle button pressess for Montage display
         class CancelPressedListener(ActionListener):
             def __init__(self, montage):
@@ -640,8 +717,8 @@ class MontageManager:
             def __init__(self, montage):
                 #
                 self.montage      = montage
-                self.mcell_height = montage.mcell_height + montage.border_width
-                self.mcell_width  = montage.mcell_width  + montage.border_width
+                self.mcell_height = montage.geom.pitch_y
+                self.mcell_width  = montage.geom.pitch_x
                 
             # Respond to the mouse being pressed
             def mousePressed(self, event):
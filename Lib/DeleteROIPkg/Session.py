@@ -20,28 +20,278 @@
  * ===============================================================================
 '''
 
-import fnmatch
+import errno
 import json
 import os
+import Queue
 import random
 import re
 import shutil
+import threading
 import traceback
 
 from   datetime             import datetime
 
+from java.nio.file          import AtomicMoveNotSupportedException, Files, Paths, StandardCopyOption
+
 # GUI Imports
 from ij.gui                 import NonBlockingGenericDialog
 
 # Our package imports
 from DeleteROIPkg.Dialogs   import show_error
 from DeleteROIPkg.Montage   import MontageManager
-from DeleteROIPkg.Utilities import addItemToList, trace, OPTIONS
+from DeleteROIPkg.Utilities import addItemToList, is_directory_empty, trace, OPTIONS
+
+# Optional streaming JSON parser, Fiji does not provide it so json.load() is used when missing
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+# Optional fast JSON encoder/decoder (CPython only), json is used when missing such as under Jython
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Constants
 DATE_FORMAT  = "%Y-%m-%d %H:%M:%S"
 GROUP_DIR    = "Group_" 
 STATE_FILE   = '.session_state.json'
+JOURNAL_FILE = '.session_state.journal'
+
+PREFETCH_SESSIONS = 1                   # Sessions queued (their images opening) while another is processed
+COMPACT_EVERY = 16                      # Journal entries (session completions) before the STATE_FILE is rewritten
+
+NOT_CACHED   = object()                 # Marker for a value not yet in a cache (None may be cached)
+STATE_ARRAYS = ('sessions', 'slides')   # Top level arrays in the STATE_FILE, streamed when using ijson
+STATE_ITEMS  = ('group', 'headers', 'options')  # Other top level items, written (sorted) before the arrays
+
+# Pattern matching the bundle change messages written to the README.txt file
+MSG_RE       = re.compile(r'slide=([0-9]+),.?bundle=([0-9]+),[ ]*(.*)')
+
+# Read only view of the session state file using ijson.  The small items (STATE_ITEMS) are read by a
+# single pass when created, stopping once all are found (the keys are written sorted so they precede the
+# arrays).  Arrays (STATE_ARRAYS) are returned as generators yielding one entry at a time and stopping at
+# the end of the array, an array must be fully consumed before the next one is requested.
+class StreamedState:
+    #
+    def __init__(self, in_file):
+        #
+        self.in_file = in_file
+        self.items   = {}
+        
+        events = self.parse()
+        for prefix, event, value in events:
+            if prefix == '' and event == 'map_key' and value in STATE_ITEMS:
+                prefix, event, first = next(events)
+                self.items[value] = StreamedState.build(event, first, events)
+                
+                if len(self.items) == len(STATE_ITEMS):
+                    break
+        
+    # Returns the item or the default if the item doesn't exist.  Arrays are always returned as a generator.
+    def get(self, key, default=None):
+        #
+        if key in STATE_ARRAYS:
+            return self.stream(key)
+        
+        return self.items.get(key, default)
+        
+    # Start parsing the file from the beginning, returning the ijson events
+    def parse(self):
+        #
+        self.in_file.seek(0)
+        
+        return ijson.parse(self.in_file)
+        
+    # Generator yielding the entries of the top level array
+    def stream(self, key):
+        #
+        events = self.parse()
+        for prefix, event, value in events:
+            if prefix == key and event == 'start_array':
+                break
+        else:
+            return
+            
+        for prefix, event, value in events:
+            if prefix == key and event == 'end_array':
+                return
+            yield StreamedState.build(event, value, events)
+        
+    # Build the value starting with the supplied (already read) event, consuming the rest of its events
+    @staticmethod
+    def build(event, value, events):
+        #
+        builder = ObjectBuilder()
+        depth   = 0
+        while True:
+            builder.event(event, value)
+            
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+                
+            if depth == 0:
+                return builder.value
+                
+            prefix, event, value = next(events)
+        
+    def __getitem__(self, key):
+        #
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        
+        return value
+
+# Write the serialized session state to the file using the supplied mode ("w" or "wb").  The state is
+# written to a temporary file that then replaces the existing one, so an interrupted write never leaves
+# a truncated state file.
+def write_state_file(filename, data, mode):
+    #
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, mode) as out_file:
+        out_file.write(data)
+        
+    source = Paths.get(temp_filename)
+    target = Paths.get(filename)
+    try:
+        Files.move(source, target, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+    except AtomicMoveNotSupportedException:
+        Files.move(source, target, StandardCopyOption.REPLACE_EXISTING)
+
+# The modification time (in ms) and size of the ROI file, None if it can't be determined.  Stored with
+# each bundle of the session state so a restore can tell the ROI file hasn't changed since.
+def roi_file_stamp(roi_path):
+    #
+    try:
+        return [int(round(os.path.getmtime(roi_path) * 1000)), os.path.getsize(roi_path)]
+    except OSError:
+        return None
+
+# Background thread writing the session state.  Each state is complete, so when several are queued
+# only the most recent is written.  Once a state has been written on_written(token) is called (on this
+# thread) with the token queued with it.  Failures are kept until returned by flush().
+class StateWriter(threading.Thread):
+    #
+    def __init__(self, on_written=None):
+        #
+        threading.Thread.__init__(self, name="DeleteROI-state-writer")
+        self.setDaemon(True)
+        
+        self.queue      = Queue.Queue()
+        self.errors     = []
+        self.on_written = on_written
+        
+    # Queue the state to be written, None stops the writer once the queue is written
+    def write(self, filename, data, mode, token=None):
+        #
+        self.queue.put((filename, data, mode, token))
+        
+    def stop(self):
+        #
+        self.queue.put(None)
+        
+    # Wait for everything queued to be written, returning (and clearing) the errors encountered
+    def flush(self):
+        #
+        self.queue.join()
+        
+        errors, self.errors = self.errors, []
+        return errors
+        
+    def run(self):
+        #
+        running = True
+        while running:
+            # Take everything queued so far, keeping only the most recent state
+            items = [self.queue.get()]
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            
+            states  = [item for item in items if item is not None]
+            running = len(states) == len(items)
+            
+            try:
+                if states:
+                    filename, data, mode, token = states[-1]
+                    write_state_file(filename, data, mode)
+                    
+                    if self.on_written is not None:
+                        self.on_written(token)
+            except BaseException as e:
+                print("ERROR: Failure writing session state: "+str(e))
+                self.errors.append(e)
+            finally:
+                for item in items:
+                    self.queue.task_done()
+
+# Background thread handing the sessions to the main loop in order.  A session is queued and then its
+# images start opening on the executor.  The queue is bounded, so only the sessions in the queue (one
+# with the default capacity) are opened ahead of the one being processed.  The bundles ignore a prefetch
+# once their image is being processed.  Iterating the prefetcher returns the sessions.
+class SessionPrefetcher(threading.Thread):
+    #
+    def __init__(self, sessions, executor, capacity=PREFETCH_SESSIONS):
+        #
+        threading.Thread.__init__(self, name="DeleteROI-session-prefetch")
+        self.setDaemon(True)
+        
+        self.sessions = sessions
+        self.executor = executor
+        self.queue    = Queue.Queue(capacity)
+        self.stopped  = False
+        
+    # Stop queueing sessions, anything already queued is discarded
+    def stop(self):
+        #
+        self.stopped = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        
+    # Queue the item, waiting for space unless the prefetcher has been stopped
+    def put(self, item):
+        #
+        while not self.stopped:
+            try:
+                self.queue.put(item, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+        
+    def run(self):
+        #
+        try:
+            for session in self.sessions:
+                if not self.put(session):
+                    return
+                
+                # If the prefetch fails the images are simply opened when the session is processed
+                try:
+                    session.prefetch_images(self.executor)
+                except BaseException as e:
+                    trace("SessionPrefetcher: unable to prefetch session {}: {}", session, e)
+        finally:
+            self.put(None)
+            
+    def __iter__(self):
+        #
+        while True:
+            session = self.queue.get()
+            if session is None:
+                return
+            yield session
 
 # Manager to handle the sessions.  Each session is potentially a subset of of the 
 # overall items to processed.  Logistically, if the set of items to be examined is really
@@ -62,8 +312,13 @@ class SessionManager:
         
         # State used by the session manager
         self.sessions         = []
+        self.completed_count  = 0       # Number of complete sessions, maintained by Session.set_complete()
         self.path             = None    # Path to directory where image/txt files are stored
         self.session_filename = None
+        self.state_writer     = None    # When set, the state is written in the background (StateWriter)
+        self.journal_filename = None
+        self.journal_len      = 0       # Entries in the journal not yet reflected in the state file
+        self.journal_seq      = 0       # Sequence number of the last journal retired (see rotate_journal())
         
         # State used to track the subdirectory used to store all group results
         self.group_path      = None
@@ -72,11 +327,7 @@ class SessionManager:
     # Determine if all sessions are complete
     def all_sessions_complete(self):
         #
-        for sess in self.sessions:
-            if not sess.is_complete():
-                return False
-        
-        return True
+        return self.completed_count == len(self.sessions)
         
     # Returns the number of sessions currently known
     def get_session_count(self):
@@ -85,18 +336,26 @@ class SessionManager:
     # Returns the number of completed sessions
     def get_completed_session_count(self):
         #
-        completed = 0
-        for sess in self.sessions:
-            if sess.is_complete():
-                completed += 1
-                
-        return completed
+        return self.completed_count
+        
+    # Recount the completed sessions, used when the set of sessions is replaced
+    def recount_completed(self):
+        #
+        self.completed_count = sum(1 for sess in self.sessions if sess.is_complete())
         
     # Store the current path we are using
     def set_src_path(self, path):
         #
         self.path, tail = os.path.split(path)
         
+        # The state file (and its journal) lives in the source directory
+        self.session_filename = os.path.join(self.path, STATE_FILE)
+        self.journal_filename = os.path.join(self.path, JOURNAL_FILE)
+        
+        # Continue numbering after any journals retired by an earlier run so they are never overwritten
+        retired          = self.retired_journals()
+        self.journal_seq = retired[-1][0] if retired else 0
+        
     # Retun the current group number
     def get_group_num(self):
         return self.group_num
@@ -119,30 +378,26 @@ class SessionManager:
         # Scan the root directory for the group looking for any existing group output.   Each
         # of those directories will be numbered starting with one (1).  Find the last one and
         # calculate the number number to use.  This directory will be created as needed.
-        matches = fnmatch.filter(os.listdir(self.path), GROUP_DIR+"[0-9]*")
+        matches = []
+        for dirname in os.listdir(self.path):
+            if dirname.startswith(GROUP_DIR) and dirname[len(GROUP_DIR):].isdigit():
+                matches.append(dirname)
+                
+                curr_group_num = int(dirname[len(GROUP_DIR):])
+                if curr_group_num > self.group_num:
+                    self.group_num = curr_group_num
         
-        trace("get_group_path: {}".format(matches))
+        trace("get_group_path: {}", matches)
         
         if len(matches) > 0:
             #
-            group_pattern = GROUP_DIR + r'([0-9]+)$'
-            #
-            for dirname in sorted(matches):
-                group_num = re.match(group_pattern, dirname).groups()
-                
-                if len(group_num) > 0 and len(group_num[0]) > 0:
-                    # 
-                    curr_group_num = int(group_num[0])
-                    if curr_group_num > self.group_num:
-                        self.group_num = curr_group_num
-            
-            # We have the last known group directory, check to see how many files within.  If none
-            # we will resuse, if any we move to the next
+            # We have the last known group directory, check to see if there are any files within.  If 
+            # none we will resuse, if any we move to the next
             target_dir = os.path.join(self.path, GROUP_DIR+"{}".format(self.group_num))
-            if len(os.listdir(target_dir)) > 0:
+            if not is_directory_empty(target_dir):
                 self.group_num += 1
             
-            trace("  +--> calculated group_num is: {}".format(self.group_num))
+            trace("  +--> calculated group_num is: {}", self.group_num)
         else:
             self.group_num = 1
             
@@ -159,35 +414,42 @@ class SessionManager:
     # stored session information
     def load_existing_state(self):
         #
-        trace("load_existing_state: path="+str(self.path))
+        trace("load_existing_state: path={}", self.path)
 
         # True if we succesfully restored the state
         restored = False
 
-        # Calculate the path to the state file
-        self.session_filename = self.path + os.path.sep + STATE_FILE
-        self.session_filename = self.session_filename.replace(os.path.sep + os.path.sep, os.path.sep)
-
         try:
-            if not os.path.exists(self.session_filename):
-                # No existing state
+            # Open the existing state, a missing file simply means there is no existing state
+            try:
+                in_file = open(self.session_filename, "r")
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                    
                 print("Session: no existing sessions found, continuing...")
                 return False
             
-            # Load the existing information, if a session loads with no bundles discard it
-            with open(self.session_filename, "r") as in_file:
-                info = json.load(in_file)
-                in_file.close
-            
-            # Storage for the sessions, we swap it on success
-            restored_sessions = []
+            # Load the existing information, if a session loads with no bundles discard it.  When ijson
+            # is available the state is streamed from the file rather than loaded all at once.
+            with in_file:
+                #
+                if ijson is not None:
+                    info = StreamedState(in_file)
+                elif orjson is not None:
+                    info = orjson.loads(in_file.read())
+                else:
+                    info = json.load(in_file)
             
-            # Restore the sessions
-            headers      = info['headers']
-            path         =     headers['path']
-            num_sessions = int(headers['num_sessions'])
-            num_slides   = int(headers['num_slides'])
-            version      =     headers['version']
+                # Restore the sessions
+                headers      = info['headers']
+                path         =     headers['path']
+                num_sessions = int(headers['num_sessions'])
+                num_slides   = int(headers['num_slides'])
+                version      =     headers['version']
+                
+                if version == '1.2':
+                    restored_sessions = self.load_state_info(info)
             
             # The original V1.0 is not entirely compatible
             if version != '1.2':
@@ -196,43 +458,6 @@ class SessionManager:
                 os.remove(self.session_filename)
                 
                 raise AssertionError("Session state encoded with unsupported version: {} - ignoring prior session state".format(version))
-            
-            # Add V1.2 changes
-            if 'group' in info:
-                group = info['group']
-            
-                # Restore  the results information
-                self.group_path = group['path']
-                self.group_num  = int(group['num'])
-                
-            if 'options' in info:
-                options = info['options']
-                
-                # Restore the options previously saved
-                OPTIONS.setAdjustType(options['adjust_type'])
-                OPTIONS.setBufferPercent(options['buffer_percent'])
-                OPTIONS.setRoiSize(options['roi_size'])
-                OPTIONS.setScale(options['scale'])
-                OPTIONS.setAddSrcColumn(options['src_column'])
-
-                # No access method at the moment
-                OPTIONS.bc_channel_1 = options['bc_channel_1']
-                OPTIONS.bc_channel_2 = options['bc_channel_2']
-                OPTIONS.bc_channel_3 = options['bc_channel_3']
-                
-                # Saturation
-                OPTIONS.setSaturation(options['c1_sat'], options['c2_sat'], options['c3_sat'])
-                
-            # Load the slide information
-            if not self.slide_mgr.load_from_session(info['slides']):
-                raise AssertionError('Failed to load slides from session')
-            
-            # Load the session information, order is important
-            for session_info in info['sessions']:
-                session = SessionManager.Session(self, 0, self.slide_mgr, self.bundle_mgr)
-                session.load_session_info(session_info)
-                
-                restored_sessions.append(session)
                 
             if len(restored_sessions) != num_sessions:
                 raise AssertionError("Expected sessions ({}) does not match actual ({})".format(num_sessions, len(restored_sessions)))
@@ -241,17 +466,69 @@ class SessionManager:
             if len(restored_sessions) == 0:
                 return False
             
-            # We have successfully loaded the session information
+            # We have successfully loaded the session information, apply anything journaled since it was written
             self.sessions = restored_sessions
             restored      = True
+            
+            self.recount_completed()
+            self.replay_journal()
         
         except BaseException as e:
             print("Unable to load existing session state: "+str(e))
-            print(traceback.print_exc(e))
+            trace(traceback.format_exc())
+            
+            # Sessions restored before the failure were counted as they were loaded
+            self.recount_completed()
             
             show_error("Failed to load session state", "Failed to restore session information: {} -> {}".format(e.__class__.__name__, str(e)))
 
         return restored
+    
+    # Restore the group, options, slides and sessions from the loaded session state returning the
+    # list of restored sessions.  The info is either the dict loaded by json or a StreamedState.
+    def load_state_info(self, info):
+        #
+        # Storage for the sessions, we swap it on success
+        restored_sessions = []
+        
+        # Add V1.2 changes
+        group = info.get('group')
+        if group is not None:
+            #
+            # Restore  the results information
+            self.group_path = group['path']
+            self.group_num  = int(group['num'])
+            
+        options = info.get('options')
+        if options is not None:
+            #
+            # Restore the options previously saved
+            OPTIONS.setAdjustType(options['adjust_type'])
+            OPTIONS.setBufferPercent(options['buffer_percent'])
+            OPTIONS.setRoiSize(options['roi_size'])
+            OPTIONS.setScale(options['scale'])
+            OPTIONS.setAddSrcColumn(options['src_column'])
+
+            # No access method at the moment
+            OPTIONS.bc_channel_1 = options['bc_channel_1']
+            OPTIONS.bc_channel_2 = options['bc_channel_2']
+            OPTIONS.bc_channel_3 = options['bc_channel_3']
+            
+            # Saturation
+            OPTIONS.setSaturation(options['c1_sat'], options['c2_sat'], options['c3_sat'])
+            
+        # Load the slide information
+        if not self.slide_mgr.load_from_session(info['slides']):
+            raise AssertionError('Failed to load slides from session')
+        
+        # Load the session information, order is important
+        for session_info in info['sessions']:
+            session = SessionManager.Session(self, 0, self.slide_mgr, self.bundle_mgr)
+            session.load_session_info(session_info)
+            
+            restored_sessions.append(session)
+            
+        return restored_sessions
 
     # Create or update the saved session state information
     def save_session_state(self):
@@ -259,10 +536,7 @@ class SessionManager:
         if self.path is None or len(self.path) == 0:
             raise ValueError("Path not properly specified")
 
-        self.session_filename = self.path + os.path.sep + STATE_FILE
-        self.session_filename = self.session_filename.replace(os.path.sep + os.path.sep, os.path.sep)
-
-        print("Session save: "+str(len(self.sessions)))
+        print("Session save: {}".format(len(self.sessions)))
         
         try:
             # Write the header
@@ -292,18 +566,19 @@ class SessionManager:
             }
             
             # Options information
+            opt         = OPTIONS
             option_info = {
-                'adjust_type'    : OPTIONS.adjust_type,
-                'buffer_percent' : OPTIONS.buffer_percent,
-                'roi_size'       : OPTIONS.roi_size,
-                'scale'          : OPTIONS.scale,
-                'src_column'     : OPTIONS.add_src_column,
-                'bc_channel_1'   : OPTIONS.bc_channel_1,
-                'bc_channel_2'   : OPTIONS.bc_channel_2,
-                'bc_channel_3'   : OPTIONS.bc_channel_3,
-                'c1_sat'         : OPTIONS.c1_sat,
-                'c2_sat'         : OPTIONS.c2_sat,
-                'c3_sat'         : OPTIONS.c3_sat
+                'adjust_type'    : opt.adjust_type,
+                'buffer_percent' : opt.buffer_percent,
+                'roi_size'       : opt.roi_size,
+                'scale'          : opt.scale,
+                'src_column'     : opt.add_src_column,
+                'bc_channel_1'   : opt.bc_channel_1,
+                'bc_channel_2'   : opt.bc_channel_2,
+                'bc_channel_3'   : opt.bc_channel_3,
+                'c1_sat'         : opt.c1_sat,
+                'c2_sat'         : opt.c2_sat,
+                'c3_sat'         : opt.c3_sat
             }
             
             # Create the output information
@@ -315,15 +590,32 @@ class SessionManager:
                 'options' : option_info,
             }
             
-            # Now write the output file
-            with open(self.session_filename, "w") as out_file:
+            # Serialize the state now so later changes aren't captured, it is only formatted to be readable
+            # when debugging.  The keys are sorted so the small items precede the arrays (see StreamedState).
+            if orjson is not None:
                 #
-                out_file.write(json.dumps(out_info, indent=4, sort_keys=True))
-                out_file.close()
+                option = (orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS) if OPTIONS.debug else orjson.OPT_SORT_KEYS
+                data   = orjson.dumps(out_info, option=option)
+                mode   = "wb"
+            elif OPTIONS.debug:
+                data   = json.dumps(out_info, indent=4, sort_keys=True)
+                mode   = "w"
+            else:
+                data   = json.dumps(out_info, separators=(',', ':'), sort_keys=True)
+                mode   = "w"
+            
+            # Now write the output file, either directly or by handing it to the background writer.  The
+            # journal so far is captured by this state, so it is retired now and discarded once written.
+            seq = self.rotate_journal()
+            if self.state_writer is not None:
+                self.state_writer.write(self.session_filename, data, mode, seq)
+            else:
+                write_state_file(self.session_filename, data, mode)
+                self.discard_journals(seq)
         
         except BaseException as e:
             print("ERROR: Failure saving existing session state: "+str(e))
-            print(traceback.print_exc(e))
+            trace(traceback.format_exc())
             
             show_error("Failed to save session state", "Failed to save session information: {} -> {}".format(e.__class__.__name__, str(e)))
             
@@ -331,6 +623,154 @@ class SessionManager:
             
         return True
     
+    # Record the completion status of the session in the journal rather than writing the entire state.
+    # Every COMPACT_EVERY entries the full state is written (see compact_session_state()).
+    def append_session_delta(self, session):
+        #
+        entry = {
+            'session_id'  : session.get_id(),
+            'is_complete' : session.is_complete(),
+            'timestamp'   : datetime.now().strftime(DATE_FORMAT)
+        }
+        
+        try:
+            with open(self.journal_filename, "a") as journal:
+                journal.write(json.dumps(entry, separators=(',', ':')) + "\n")
+        except BaseException as e:
+            # Without the journal fall back to writing the entire state
+            print("ERROR: Failure writing session journal: "+str(e))
+            return self.compact_session_state()
+        
+        self.journal_len += 1
+        if self.journal_len >= COMPACT_EVERY:
+            return self.compact_session_state()
+            
+        return True
+        
+    # Write the full session state, the journal entries it captures are discarded once it is written.  When
+    # writing in the background this doesn't wait for the write.
+    def compact_session_state(self):
+        #
+        return self.save_session_state()
+        
+    # Final checkpoint, the full state is only written when the journal holds entries not yet in it
+    def checkpoint_session_state(self):
+        #
+        if self.journal_len == 0:
+            return True
+            
+        return self.compact_session_state()
+        
+    # Retire the current journal as its entries are captured by the state about to be written.  New entries
+    # go to a fresh journal.  Returns the sequence number to pass to discard_journals() once written.
+    def rotate_journal(self):
+        #
+        self.journal_seq += 1
+        self.journal_len  = 0
+        
+        if os.path.exists(self.journal_filename):
+            os.rename(self.journal_filename, "{}.{}".format(self.journal_filename, self.journal_seq))
+            
+        return self.journal_seq
+        
+    # Discard the retired journals up to and including seq, their entries are reflected in the state file.
+    # Journals retired for a state that failed to be written are kept until a later state is written.
+    def discard_journals(self, seq):
+        #
+        for retired_seq, filename in self.retired_journals():
+            if retired_seq <= seq:
+                os.remove(filename)
+                
+    # Discard every journal, retired and current.  Used when new sessions replace those the journals
+    # refer to since the session ids are reused.
+    def clear_journals(self):
+        #
+        self.journal_len = 0
+        
+        for retired_seq, filename in self.retired_journals():
+            os.remove(filename)
+            
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+                
+    # The retired journals still on disk as (sequence, filename) in the order they were retired
+    def retired_journals(self):
+        #
+        path, name = os.path.split(self.journal_filename)
+        prefix     = name + "."
+        retired    = []
+        
+        try:
+            for entry in os.listdir(path):
+                if entry.startswith(prefix) and entry[len(prefix):].isdigit():
+                    retired.append((int(entry[len(prefix):]), os.path.join(path, entry)))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+                
+        retired.sort()
+        return retired
+        
+    # Apply the journals written since the state file to the loaded sessions, the retired journals
+    # (oldest first) and then the current one
+    def replay_journal(self):
+        #
+        retired   = self.retired_journals()
+        filenames = [filename for retired_seq, filename in retired] + [self.journal_filename]
+        sessions  = dict((session.get_id(), session) for session in self.sessions)
+        
+        if retired:
+            self.journal_seq = retired[-1][0]
+        
+        for filename in filenames:
+            try:
+                journal = open(filename, "r")
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            
+            with journal:
+                for line in journal:
+                    # A partially written (last) line is ignored
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                        
+                    session = sessions.get(entry['session_id'])
+                    if session is not None:
+                        session.set_complete(entry['is_complete'])
+                        
+                    self.journal_len += 1
+        
+    # Write the session state in the background from now on, see stop_background_saves()
+    def start_background_saves(self):
+        #
+        if self.state_writer is None:
+            self.state_writer = StateWriter(self.discard_journals)
+            self.state_writer.start()
+            
+    # Wait for any background writes of the session state to complete and write in the foreground again.  
+    # Returns False (after reporting it) if any of the background writes failed.
+    def stop_background_saves(self):
+        #
+        writer = self.state_writer
+        if writer is None:
+            return True
+        
+        self.state_writer = None
+        writer.stop()
+        errors = writer.flush()
+        
+        if len(errors) > 0:
+            e = errors[-1]
+            show_error("Failed to save session state", "Failed to save session information: {} -> {}".format(e.__class__.__name__, str(e)))
+            
+            return False
+            
+        return True
+    
     # Reset all session information including the underlying managers.  If we are told not to re-use the 
     # session information we need to make it go away.
     def reset(self):
@@ -339,6 +779,7 @@ class SessionManager:
         
         self.sessions   = []
         self.group_num  = 0
+        self.recount_completed()
         self.group_path = None
         
         self.slide_mgr.reset()
@@ -360,11 +801,15 @@ class SessionManager:
         #
         session = None
         
+        # Zero (or less) means there is no limit, everything goes into a single session
+        if roi_per_session <= 0:
+            roi_per_session = float('inf')
+        
         # Determine the group path that should be used
         self.setup_group_path()
         
         # Buld an array of bundles and then randomize them
-        random_bundles = [bundle for bundle in self.bundle_mgr ]
+        random_bundles = list(self.bundle_mgr)
         random.shuffle(random_bundles) 
         
         # Now loop through each bundle and adding it to the session
@@ -373,10 +818,10 @@ class SessionManager:
         for bundle in random_bundles:
             
             if not bundle.is_enabled():
-                trace("  +--> bundle is not enabled, skipping: "+str(bundle))
+                trace("  +--> bundle is not enabled, skipping: {}", bundle)
                 continue
             if bundle.get_roi_length() == 0:
-                trace("  +--> zero length ROI, skipping: "+str(bundle))
+                trace("  +--> zero length ROI, skipping: {}", bundle)
                 continue
            
             # Ensure we have allocated the session
@@ -390,11 +835,22 @@ class SessionManager:
             if session.get_num_roi() >= roi_per_session:
                 session = None
                 
-        # Now save all of the just created session information
+        # Open the images of each session in directory order, this is the order saved and restored
+        self.sort_by_slide()
+        
+        # Now save all of the just created session information, any journal refers to the sessions replaced
+        self.clear_journals()
         self.save_session_state()
         
         return True
     
+    # Order the bundles of each session by their image path so the images are opened in directory order.
+    # The sessions themselves keep their order (and ids), the ROI are still shown in random order.
+    def sort_by_slide(self):
+        #
+        for session in self.sessions:
+            session.sort_bundles()
+    
     # Find sesssion by ID
     def find_session_by_id(self, session_id):
         #
@@ -419,6 +875,11 @@ class SessionManager:
             self.bundles         = []
             self.slides          = []
             self.status_complete = False
+            self.num_roi         = 0       # Total ROI across the bundles, maintained by add_bundle
+            
+            # Identities of the bundles/slides above for fast membership checks
+            self.bundle_ids      = set()
+            self.slide_ids       = set()
 
         # Retrieve the session ID
         def get_id(self):
@@ -436,11 +897,7 @@ class SessionManager:
         # Return the number of ROI associated with this session
         def get_num_roi(self):
             #
-            num_roi = 0
-            for bundle in self.bundles:
-                num_roi += bundle.get_roi_info().get_roi_count()
-                
-            return num_roi
+            return self.num_roi
             
         # Return the number of deletions (culled) associated with this session
         def get_culled_count(self):
@@ -451,25 +908,49 @@ class SessionManager:
             return self.status_complete
             
         def set_complete(self, status):
+            if bool(status) != bool(self.status_complete):
+                self.session_mgr.completed_count += 1 if status else -1
             self.status_complete = status
             
         # Add a bundle to be processed
         def add_bundle(self, bundle):
             #
-            trace("session.addBundle: "+str(bundle))
+            trace("session.addBundle: {}", bundle)
             
-            if bundle not in self.bundles:
+            if id(bundle) not in self.bundle_ids:
+                self.bundle_ids.add(id(bundle))
                 self.bundles.append(bundle)
+                self.num_roi += bundle.get_roi_count()
             else:
                 trace("  +--> bundle already added, ignoring")
                 
-            if bundle.slide and bundle.slide not in self.slides:
-                self.slides.append(bundle.slide)
-            else:
-                trace("  +--> add to slide skipped: "+str(bundle.slide))
+            if not bundle.slide or not self.add_slide(bundle.slide):
+                trace("  +--> add to slide skipped: {}", bundle.slide)
+                
+        # Add a slide to the session, returns False if it was already present
+        def add_slide(self, slide):
+            #
+            if id(slide) in self.slide_ids:
+                return False
+            
+            self.slide_ids.add(id(slide))
+            self.slides.append(slide)
+            
+            return True
+                
+        # Sort the bundles by image path, the sort is stable so bundles sharing an image keep their order
+        def sort_bundles(self):
+            #
+            self.bundles.sort(key=lambda bundle: bundle.image_path)
+            
+        # Start opening the images of the bundles in the background using the supplied executor
+        def prefetch_images(self, executor):
+            #
+            for bundle in self.bundles:
+                bundle.prefetch_image(executor)
                 
         # Process the session using the MontageManager to create montages
-        def process(self, columns, roi_size, max_rows):
+        def process(self, columns, roi_size, max_rows, parallelism=None):
             #
             if len(self.bundles) == 0:
                 trace("Session.process: no bundles to process")
@@ -479,22 +960,21 @@ class SessionManager:
             start_time = datetime.now()
             
             # Additional montage creation and other functions can follow here...
-            mm = MontageManager(self.session_id, columns, max_rows, roi_size)
+            mm = MontageManager(self.session_id, columns, max_rows, roi_size, parallelism=parallelism)
             
-            # Preserve the Slides so we can intelligently group the Montages and handle restarts
-            for bundle in self.bundles:
-                mm.add_bundle(bundle)
-                
-                if bundle.slide and bundle.slide not in self.slides:
-                    self.slides.append(bundle.slide)
+            # The Slides were already recorded as the bundles were added (add_bundle/load_session_info)
+            mm.add_bundles(self.bundles)
             
             # Now lock the bundles and create the montage, we get an array of montages
             mm.lock_bundles(OPTIONS.debug)
             montages = mm.create_montage(max_rows)
         
-            # Now iterate over the montages displaying them
-            for montage in mm:
-                montage.process_montage(OPTIONS.scale)
+            # Now iterate over the montages displaying them.  The cell extraction pool is kept for the session.
+            try:
+                for montage in mm:
+                    montage.process_montage()
+            finally:
+                mm.shutdown()
                 
             # Write out all changes
             completed, changes, no_changes = self.save_changes(dry_run=True)
@@ -522,8 +1002,8 @@ class SessionManager:
             if results.wasCanceled():
                 raise UserWarning("Cancel")
             
-            # Save the ROI information
-            self.save_changes()
+            # Save the ROI information using the changes determined by the dry run above
+            self.save_changes(reuse_plan=True)
             
             # Update the session state to indicate we have completed this session
             self.set_complete(True)
@@ -532,16 +1012,23 @@ class SessionManager:
             self.update_readme(start_time, completed, "{}\n\n{}".format(mod_messages, not_messages))
             
         # Save the changes that have occured in the bundles
-        def save_changes(self, dry_run=False):
+        def save_changes(self, dry_run=False, reuse_plan=False):
             #
             completed  = True
             success    = []
             failed     = []
             group_path = self.session_mgr.get_group_path()
             
-            # Ensure the directory exists
-            if not os.path.exists(group_path):
-                os.mkdir(group_path)
+            # Ensure the directory exists (no exist_ok in Jython 2.7)
+            try:
+                os.makedirs(group_path)
+            except OSError:
+                if not os.path.isdir(group_path):
+                    raise
+            
+            # Bound methods for the loop below
+            success_extend = success.extend
+            failed_extend  = failed.extend
             
             for bundle in self.bundles:
             
@@ -549,14 +1036,14 @@ class SessionManager:
                     continue
                  
                 # Save the changes and result the results
-                result, errors, msgs = bundle.save_changes(group_path, dry_run)
+                result, errors, msgs = bundle.save_changes(group_path, dry_run, reuse_plan)
                 
                 # If the result failed we will return an overall False
                 if not result:
                     completed = False
     
-                success  += msgs
-                failed   += errors
+                success_extend(msgs)
+                failed_extend(errors)
             
             # Return out values
             return completed, success, failed
@@ -575,6 +1062,9 @@ class SessionManager:
             if len(bundles) != num_bundles:
                 raise AssertionError("Number of expected bundles ({}) does not match actual ({})".format(num_bundles, len(bundles)))
             
+            # Slides already looked up for this session by slide root, None is a valid (cached) result
+            slide_cache = {}
+            
             # Now process the bundles, it's important that the order be maintained 
             for entry in bundles:
                 bundle_id  =  int(entry['bid'])
@@ -584,8 +1074,15 @@ class SessionManager:
                 is_enabled = bool(entry['is_enabled'])
                 slide_root =      entry['slide_root']
                 
-                # Create the bundle
-                bundle = self.bundle_mgr.create_bundle(image_path, roi_path, bundle_id)
+                # Create the bundle, a completed session is not processed again so its ROI data is only
+                # parsed if something asks for it.  That requires the ROI file to be unchanged since the
+                # state was saved, otherwise it is parsed now so the size is validated below.
+                expected_roi_size = None
+                if is_complete:
+                    roi_stamp = entry.get('roi_stamp')
+                    if roi_stamp is not None and [int(value) for value in roi_stamp] == roi_file_stamp(roi_path):
+                        expected_roi_size = roi_size
+                bundle = self.bundle_mgr.create_bundle(image_path, roi_path, bundle_id, expected_roi_size)
                 bundle.set_enabled(is_enabled)
 
                 if bundle.get_roi_length() != roi_size:
@@ -595,13 +1092,16 @@ class SessionManager:
                 self.add_bundle(bundle)
 
                 # Ensure it is attached to the slide (if appropriate).  These are created earlier by the mgr
-                slide = self.slide_mgr.find_slide(slide_root)
+                slide = slide_cache.get(slide_root, NOT_CACHED)
+                if slide is NOT_CACHED:
+                    slide = self.slide_mgr.find_slide(slide_root)
+                    slide_cache[slide_root] = slide
+                    
                 if slide is not None:
                     bundle.attach_slide(slide)
                     slide.add_bundle(bundle)
                     
-                    if slide not in self.slides:
-                        self.slides.append(slide)
+                    self.add_slide(slide)
 
             # Now save the is_complete status
             self.set_complete(is_complete)
@@ -617,9 +1117,8 @@ class SessionManager:
             info['num_slides']     = self.get_num_slides()
             info['is_complete']    = self.is_complete()
             
-            bundle_info = []
-            for index in range(0, num_bundles):
-                bundle = self.bundles[index]
+            bundle_info = [None] * num_bundles
+            for index, bundle in enumerate(self.bundles):
                 #
                 entry = {}
                 entry['index']      = index
@@ -627,10 +1126,11 @@ class SessionManager:
                 entry['image_path'] = bundle.get_image_path()
                 entry['roi_path']   = bundle.get_roi_path()
                 entry['roi_size']   = bundle.get_roi_length()
+                entry['roi_stamp']  = roi_file_stamp(bundle.get_roi_path())
                 entry['is_enabled'] = bundle.is_enabled()
                 entry['slide_root'] = bundle.get_slide_root()
                 
-                bundle_info.append(entry)
+                bundle_info[index] = entry
                 
             info['bundles'] = bundle_info
         
@@ -642,90 +1142,78 @@ class SessionManager:
             session_mgr = self.session_mgr
             readme_path = os.path.join(session_mgr.get_group_path(), "README.txt")
             
-            # Determine if the path exist, if not we need to create it and then append the results
+            # The README is built up and written with a single write.  If the file doesn't exist yet it
+            # starts with the group summary information.
             try:
-                if not os.path.isfile(readme_path):
+                lines = []
+            
+                if not os.path.exists(readme_path):
                     #
-                    readme_file = open(readme_path, 'w')
-                    
-                    readme_file.write("Group {} Summary Information\n\n".format(session_mgr.group_num))
-                    readme_file.write("   Processed directory: {}\n".format(session_mgr.path))
-                    readme_file.write("\n")
-                    readme_file.write("Options Parameters\n");
-                    readme_file.write("------------------\n");
-                    
-                    if OPTIONS.adjust_type == OPTIONS.TYPE_ADJUST_MIN_MAX:
-                        readme_file.write("  Adjust Type: Min/Max\n")
-                        readme_file.write("    Channel 1:  Min={}  Max={}\n".format(OPTIONS.getBcMin(1), OPTIONS.getBcMax(1)))
-                        readme_file.write("    Channel 2:  Min={}  Max={}\n".format(OPTIONS.getBcMin(2), OPTIONS.getBcMax(2)))
-                        readme_file.write("    Channel 3:  Min={}  Max={}\n".format(OPTIONS.getBcMin(3), OPTIONS.getBcMax(3)))
-                    elif OPTIONS.adjust_type == OPTIONS.TYPE_ADJUST_SATURATION:
-                        readme_file.write("  Adjust Type: Saturation\n")
-                        readme_file.write("    Channel 1:  {}\n".format(OPTIONS.c1_sat))
-                        readme_file.write("    Channel 2:  {}\n".format(OPTIONS.c2_sat))
-                        readme_file.write("    Channel 3:  {}\n".format(OPTIONS.c3_sat))
-                    elif OPTIONS.adjust_type == OPTIONS.TYPE_ADJUST_MANUAL:
-                        readme_file.write("  Adjust Type: Manual\n")
-                    
-                    readme_file.write("  ROI Size: {}\n".format(OPTIONS.roi_size))
-                    readme_file.write("  Scale   : {}\n".format(OPTIONS.scale))
-                    readme_file.write("  Column #: {}\n".format(OPTIONS.add_src_column))
-                    readme_file.write("\n")
-                    readme_file.write("SESSION PROCESSING INFORMATION:\n")
-                    readme_file.write("-------------------------------\n")
-                else:
-                    readme_file = open(readme_path, 'a')
-                    
-                # Now add the current session information
-                readme_file.write("  Session #{} - Processing Information\n".format(self.get_id()))
-                readme_file.write("     Start Time: {}\n".format(start_time.strftime(DATE_FORMAT)))
-                readme_file.write("     End Time  : {}\n".format(datetime.now().strftime(DATE_FORMAT)))
-                readme_file.write("\n")
-                readme_file.write("     ----- Messages -----\n")
+                    lines.append("Group {} Summary Information\n\n".format(session_mgr.group_num))
+                    lines.append("   Processed directory: {}\n".format(session_mgr.path))
+                    lines.append("\n")
+                    lines.append("Options Parameters\n")
+                    lines.append("------------------\n")
+                
+                    opt = OPTIONS
+
+                    if opt.adjust_type == opt.TYPE_ADJUST_MIN_MAX:
+                        lines.append("  Adjust Type: Min/Max\n")
+                        lines.append("    Channel 1:  Min={}  Max={}\n".format(opt.getBcMin(1), opt.getBcMax(1)))
+                        lines.append("    Channel 2:  Min={}  Max={}\n".format(opt.getBcMin(2), opt.getBcMax(2)))
+                        lines.append("    Channel 3:  Min={}  Max={}\n".format(opt.getBcMin(3), opt.getBcMax(3)))
+                    elif opt.adjust_type == opt.TYPE_ADJUST_SATURATION:
+                        lines.append("  Adjust Type: Saturation\n")
+                        lines.append("    Channel 1:  {}\n".format(opt.c1_sat))
+                        lines.append("    Channel 2:  {}\n".format(opt.c2_sat))
+                        lines.append("    Channel 3:  {}\n".format(opt.c3_sat))
+                    elif opt.adjust_type == opt.TYPE_ADJUST_MANUAL:
+                        lines.append("  Adjust Type: Manual\n")
+                
+                    lines.append("  ROI Size: {}\n".format(opt.roi_size))
+                    lines.append("  Scale   : {}\n".format(opt.scale))
+                    lines.append("  Column #: {}\n".format(opt.add_src_column))
+                    lines.append("\n")
+                    lines.append("SESSION PROCESSING INFORMATION:\n")
+                    lines.append("-------------------------------\n")
                 
-                msg_re = re.compile('.*?slide=([0-9]+),.?bundle=([0-9]+),[ ]*(.*)')
+                # Now add the current session information
+                lines.append("  Session #{} - Processing Information\n".format(self.get_id()))
+                lines.append("     Start Time: {}\n".format(start_time.strftime(DATE_FORMAT)))
+                lines.append("     End Time  : {}\n".format(datetime.now().strftime(DATE_FORMAT)))
+                lines.append("\n")
+                lines.append("     ----- Messages -----\n")
+            
                 for m in messages.split('\n'):
-                    trace(">>> {}".format(m))
-                    result = msg_re.match(m)
+                    trace(">>> {}", m)
+                    result = MSG_RE.search(m)
                     if result:
                         slide_id, bundle_id, msg = result.groups()
                         bundle = self.bundle_mgr.find_bundle_by_id(bundle_id)
                         # A bit of a hack, we want to reference the roi_file in the Group directory
                         roi_fn = bundle.get_roi_filename().replace("-active","") if bundle else "Bundle ID: {}".format(bundle_id)
-                        readme_file.write("        file={}, {}\n".format(roi_fn, msg))
+                        lines.append("        file={}, {}\n".format(roi_fn, msg))
                     else:
-                        readme_file.write("     {}\n".format(m))
-                readme_file.write("\n")
-                
-                # All done, close the file
-                readme_file.close()
+                        lines.append("     {}\n".format(m))
+                lines.append("\n")
+            
+                # Append to (or create) the file
+                with open(readme_path, 'a') as readme_file:
+                    readme_file.write("".join(lines))
                     
             except BaseException as e:
-                trace("Unable to write README.txt file: {}".format(str(e)))
-                trace("{}".format(traceback.format_exc())) 
-                
-                if readme_file:
-                    readme_file.close()
+                trace("Unable to write README.txt file: {}", str(e))
+                trace(traceback.format_exc())
             
     # Iterator to access available sessions
     def __iter__(self):
-        # Iterator to iterate over entry indices
-        if self.sessions is None or len(self.sessions) == 0:
-            return None
+        #
+        return iter(self.sessions)
         
-        self._index = 0
-        return self
-
-    def __next__(self):
-        # Next method for iterator (python3)
-        if self._index < len(self.sessions):
-            result = self.sessions[self._index]
-            self._index += 1
-            return result
-        else:
-            raise StopIteration
-            
-    def next(self):
-        # Next method for iterator (python2)
-        return self.__next__()
+    # Generator over the sessions still to be processed, in session order
+    def incomplete_sessions(self):
+        #
+        for session in self.sessions:
+            if not session.is_complete():
+                yield session
         
\ No newline at end of file
@@ -26,6 +26,57 @@ import re
 # Our package imports
 from DeleteROIPkg.Utilities import close_all, trace, OPTIONS
 
+# Matches an underscore or (escaped) space in an escaped root, these are replaced to match either
+SEPARATOR_RE  = re.compile(r'_|\\ ')
+
+# Compiled matchers keyed by root filename, so identical roots only compile their pattern once
+ROOT_MATCHERS = {}
+
+# Return the compiled matcher for a root filename, an underscore or space in the root matches either
+def compile_root(root):
+    #
+    matcher = ROOT_MATCHERS.get(root)
+    
+    if matcher is None:
+        pattern = SEPARATOR_RE.sub(r'[_ ]', re.escape(root)).replace(r'\[', '[')
+        matcher = re.compile(pattern)
+        
+        ROOT_MATCHERS[root] = matcher
+        
+    return matcher
+
+# Intern a root filename so the repeated comparisons and lookups of it are cheap.  Roots that can't be
+# interned (i.e., non-ASCII unicode) are used as is.
+def intern_root(root):
+    #
+    if root is None:
+        return None
+        
+    try:
+        return intern(str(root))
+    except (TypeError, UnicodeError):
+        return root
+
+# Beyond this many underscores/spaces in a root the regex is used rather than literal prefixes
+MAX_PREFIX_EXPANSION = 6
+
+# Return the literal prefixes a root matches (each underscore/space expanded to both), or None when 
+# the root contains a character class or would expand into too many prefixes
+def root_prefixes(root):
+    #
+    if '[' in root:
+        return None
+        
+    parts = re.split(r'[_ ]', root)
+    if len(parts) - 1 > MAX_PREFIX_EXPANSION:
+        return None
+    
+    prefixes = [parts[0]]
+    for part in parts[1:]:
+        prefixes = [prefix + separator + part for prefix in prefixes for separator in ('_', ' ')]
+        
+    return tuple(prefixes)
+
 # Class representing a slides (i.e., coverslip).
 class SlideManager:
     #
@@ -34,25 +85,25 @@ class SlideManager:
     # Constructor
     def __init__(self):
         #
-        self.slides = []
+        self.slides     = []
+        self.root_index = {}    # Slides keyed by root filename
         
     # Add a root filename
     def add_slide_root(self, root):
         #
         slide = None
+        root  = intern_root(root)
         
         if not root in self:
             SlideManager.next_slide_id += 1
             slide = SlideManager.Slide(SlideManager.next_slide_id, root)
             
             self.slides.append(slide)
+            self.root_index[root] = slide
         else:
-            for entry in self.slides:
-                if entry.root_filename == root:
-                    slide = entry
-                    break
+            slide = self.root_index[root]
             #
-            trace("SlideMgr: attempt to add root multiple times: "+str(root))
+            trace("SlideMgr: attempt to add root multiple times: {}", root)
             
         return slide
             
@@ -62,8 +113,10 @@ class SlideManager:
         if filename is None:
             return None
         
-        # Now try and find a match
-        match = None
+        # A root filename maps directly to its slide, otherwise try and find a match
+        match = self.root_index.get(filename)
+        if match is not None:
+            return match
         
         for slide in self.slides:
             if slide.is_covered(filename):
@@ -75,18 +128,21 @@ class SlideManager:
     # Load the slides from session state
     def load_from_session(self, session_info):
         #
-        saved_slides = self.slides
+        saved_slides = list(self.slides)
+        saved_index  = dict(self.root_index)
         
         try:
             for session in session_info:
                 slide = SlideManager.Slide(0, "X")
                 slide.load_session_info(session)
                 self.slides.append(slide)
+                self.root_index[slide.root_filename] = slide
                 
                 # Ensure that any future slides have distinct ID's
                 SlideManager.next_slide_id = len(self.slides)
         except BaseException as e:
-            self.slides = saved_slides
+            self.slides     = saved_slides
+            self.root_index = saved_index
             raise e
         
         return True
@@ -95,7 +151,8 @@ class SlideManager:
     def reset(self):
         #
         SlideManager.next_slide_id = 0
-        self.slides = []
+        self.slides     = []
+        self.root_index = {}
 
     # Implement IN logic such that "root in SlideMgr" works.
     def __contains__(self, item):
@@ -103,37 +160,12 @@ class SlideManager:
         if item is None:
             return False
             
-        matched = False
-        
-        for entry in self.slides:
-            #
-            if entry.root_filename == item:
-                matched = True
-                break
-        
-        return matched
+        return item in self.root_index
 
     # Iterator to access available montages
     def __iter__(self):
-        # Iterator to iterate over entry indices
-        if self.slides is None or len(self.slides) == 0:
-            return  None        
-        
-        self._index = 0
-        return self
-
-    def __next__(self):
-        # Next method for iterator (python3)
-        if self._index < len(self.slides):
-            result = self.slides[self._index]
-            self._index += 1
-            return result
-        else:
-            raise StopIteration
-            
-    def next(self):
-        # Next method for iterator (python2)
-        return self.__next__()
+        # Iterate directly over the slides list
+        return iter(self.slides)
 
     # Implement len()
     def __len__(self):
@@ -155,13 +187,16 @@ class SlideManager:
             self.slide_id       = slide_id
             self.root_filename  = root
             
-            # Define the matcher we use to find the match
-            self.pattern        = re.sub(r'_|\\ ', r'[_ ]', re.escape(root)).replace(r'\[', '[')
-            self.matcher        = re.compile(self.pattern)
+            # Define the matcher we use to find the match (the pattern is available as matcher.pattern)
+            self.matcher        = compile_root(root)
+            self.prefixes       = root_prefixes(root)
 
             # The set of bundles associated with this slide
             self.bundles        = []
-            self.random_bundles = None
+            self.bundle_ids     = set()     # id() of each entry in bundles, for fast membership checks
+            self.roi_total      = 0         # Total ROI across the bundles, maintained by add_bundle
+            self.random_order   = None      # Shuffled indices into bundles while being consumed
+            self.random_pos     = None      # Next position in random_order to consume
             self.status_enabled = False
             
         # Returns the root filename
@@ -171,7 +206,10 @@ class SlideManager:
 
         # Determine if the provided filename is covered by this slide
         def is_covered(self, filename):
-            #
+            # Literal roots are a simple prefix compare, only fall back to the regex when needed
+            if self.prefixes is not None:
+                return filename.startswith(self.prefixes)
+                
             match = self.matcher.match(filename)
             
             return match is not None
@@ -196,33 +234,24 @@ class SlideManager:
         # Returns the number of RoiInfo objects associated with the bundles we are associated with
         def get_num_roi(self):
             #
-            num_roi = 0
-            
-            for bundle in self.bundles:
-                #
-                num_roi += bundle.get_roi_length()
+            return self.roi_total
             
-            return num_roi
-            
-        #Returns the number of RoiInfo objects being culled
+        # Returns the number of RoiInfo objects being culled, each RoiInfo keeps its own count.  Bundles whose
+        # ROI data hasn't been parsed (deferred) have nothing culled in memory so they are skipped.
         def get_culled_count(self):
             #
-            num_culled = 0
-            
-            for bundle in self.bundles:
-                #
-                num_culled += bundle.get_roi_info().get_culled_count()
-            
-            return num_culled            
+            return sum(bundle.roi_info.get_culled_count() for bundle in self.bundles if bundle.roi_info is not None)
             
         # Store the set of bundles associated with this slide
         def add_bundle(self, bundle):
             #
-            if self.random_bundles is not None:
+            if self.random_order is not None:
                 raise ValueError("Bundles locked due to randomization/consumption")
             
-            if not bundle in self.bundles:
+            if id(bundle) not in self.bundle_ids:
+                self.bundle_ids.add(id(bundle))
                 self.bundles.append(bundle)
+                self.roi_total += bundle.get_roi_length()
 
         # Randomizing the bundles, consumes the next item in the list.  Once we have consumed all of
         # the entries, return None.  After None is returned subsequent calls will reset and start 
@@ -231,31 +260,35 @@ class SlideManager:
             #
             result = None
             
-            if self.random_bundles is None:
-                # Randomize the current list so that consumption of the bundles is random
-                self.random_bundles = list(self.bundles)
-                for i in range(0, len(self.bundles)):
-                    random.shuffle(self.random_bundles)
+            if self.random_order is None:
+                # Randomize the order the bundles are consumed in, the bundles themselves are not copied
+                order = range(len(self.bundles))
+                random.shuffle(order)
+                
+                self.random_order = tuple(order)
+                self.random_pos   = 0
                     
-            # If we consumed all of the entries, clear the random list.
-            if len(self.random_bundles) > 0:
-                result = self.random_bundles.pop(0)
+            # If we consumed all of the entries, clear the random order.
+            if self.random_pos < len(self.random_order):
+                result = self.bundles[self.random_order[self.random_pos]]
+                self.random_pos += 1
             else:
-                self.random_bundles = None
+                self.random_order = None
+                self.random_pos   = None
                     
             return result
 
         # Update the saved session state information to show this session has completed
         def load_session_info(self, session_info):
             #
-            slide_id      =  int(session_info['slide_id'])
-            root_filename =  str(session_info['root_filename'])
-            
-            # Recall the constructor to setup
-            self.__init__(slide_id, root_filename)
+            # The values are written with their native types by save_session_info
+            self.slide_id       = session_info['slide_id']
+            self.root_filename  = intern_root(session_info['root_filename'])
+            self.status_enabled = session_info['is_enabled']
             
-            # Now the remaining state
-            self.status_enabled    = bool(session_info['is_enabled'])
+            # The matching depends on the root
+            self.matcher        = compile_root(self.root_filename)
+            self.prefixes       = root_prefixes(self.root_filename)
             
         # Create information about the session to write to storage
         def save_session_info(self):
@@ -269,25 +302,8 @@ class SlideManager:
 
         # Iterator to access available bundles in the slide
         def __iter__(self):
-            # Iterator to iterate over entry indices
-            if self.bundles is None or len(self.bundles) == 0:
-                return  None        
-            
-            self._index = 0
-            return self
-    
-        def __next__(self):
-            # Next method for iterator (python3)
-            if self._index < len(self.bundles):
-                result = self.bundles[self._index]
-                self._index += 1
-                return result
-            else:
-                raise StopIteration
-                
-        def next(self):
-            # Next method for iterator (python2)
-            return self.__next__()
+            # Iterate directly over the bundles list
+            return iter(self.bundles)
 
         # Implement len()
         def __len__(self):
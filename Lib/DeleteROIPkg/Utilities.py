@@ -23,15 +23,18 @@
 # Standard Python imports
 #import locale
 import re
+import threading
 import traceback
 
 # Java Imports
 from java.awt        import Color, Font
+from java.lang       import Runtime, StringBuilder
+from java.nio.file   import Files, Paths
 from java.util       import Locale
 from java.text       import NumberFormat
 
 # ImageJ Imports
-from ij              import IJ, Prefs
+from ij              import IJ, Prefs, WindowManager
 from ij.util         import FontUtil
 
 # Define constants
@@ -41,31 +44,68 @@ parm_max_rows      = 10           # Montage - max number of rows
 parm_screen_height = 0            # Total Screen height
 parm_screen_width  = 0            # Total Screen width
 
+TRACE_ENABLED      = False        # Tracing state, kept here so trace() avoids the OPTIONS lookup (see Options.trace)
+
+LOG_FLUSH_EVERY    = 32           # Buffered log lines (see log()) written together
+LOG_BUFFER         = StringBuilder(4096)
+LOG_PENDING        = 0            # Lines currently held in LOG_BUFFER
+LOG_LOCK           = threading.RLock()  # trace() (which flushes) may be called from background threads
+
 # Helper classes
 
 # Holder of all global options (usually modifiable by UI)
-class Options:
+class Options(object):
     #
     PREFS_PREFIX = "DeleteROI."
+    
+    # All instance attributes, fixed so they are stored in slots rather than a per-instance dict
+    __slots__ = ('adjust_type', 'buffer_percent', 'bc_channel_1', 'bc_channel_2', 'bc_channel_3', 'bc_parsed',
+                 'c1_sat', 'c2_sat', 'c3_sat', 'debug', 'num_threads', 'roi_size', 'scale', 'src_folder',
+                 'add_src_column', 'add_src_name', 'keep_heading', 'keep_unused', 'rem_blank_cols',
+                 'prefs_loaded', 'prefs_loader', 'saved_prefs')
 
-    PREF_KEY_ADJUST_TYPE    = "{}{}".format(PREFS_PREFIX, "adjust_type")
-    PREF_KEY_BUFFER_PERCENT = "{}{}".format(PREFS_PREFIX, "buffer_percent")
-    PREF_KEY_BC_CHANNEL_1   = "{}{}".format(PREFS_PREFIX, "bc_channel_1")
-    PREF_KEY_BC_CHANNEL_2   = "{}{}".format(PREFS_PREFIX, "bc_channel_2")
-    PREF_KEY_BC_CHANNEL_3   = "{}{}".format(PREFS_PREFIX, "bc_channel_3")
-    PREF_KEY_C1_SAT         = "{}{}".format(PREFS_PREFIX, "c1_sat")
-    PREF_KEY_C2_SAT         = "{}{}".format(PREFS_PREFIX, "c2_sat")
-    PREF_KEY_C3_SAT         = "{}{}".format(PREFS_PREFIX, "c3_sat")
-    PREF_KEY_DEBUG          = "{}{}".format(PREFS_PREFIX, "debug")
-    PREF_KEY_ROI_SIZE       = "{}{}".format(PREFS_PREFIX, "roi_size")
-    PREF_KEY_SCALE          = "{}{}".format(PREFS_PREFIX, "scale")
-    PREF_KEY_SRC_FOLDER     = "{}{}".format(PREFS_PREFIX, "src_folder")
+    PREF_KEY_ADJUST_TYPE    = "DeleteROI.adjust_type"
+    PREF_KEY_BUFFER_PERCENT = "DeleteROI.buffer_percent"
+    PREF_KEY_BC_CHANNEL_1   = "DeleteROI.bc_channel_1"
+    PREF_KEY_BC_CHANNEL_2   = "DeleteROI.bc_channel_2"
+    PREF_KEY_BC_CHANNEL_3   = "DeleteROI.bc_channel_3"
+    PREF_KEY_C1_SAT         = "DeleteROI.c1_sat"
+    PREF_KEY_C2_SAT         = "DeleteROI.c2_sat"
+    PREF_KEY_C3_SAT         = "DeleteROI.c3_sat"
+    PREF_KEY_DEBUG          = "DeleteROI.debug"
+    PREF_KEY_NUM_THREADS    = "DeleteROI.num_threads"
+    PREF_KEY_ROI_SIZE       = "DeleteROI.roi_size"
+    PREF_KEY_SCALE          = "DeleteROI.scale"
+    PREF_KEY_SRC_FOLDER     = "DeleteROI.src_folder"
     
-    PREF_KEY_ADD_SRC_COLUMN = "{}{}".format(PREFS_PREFIX, "add_src_column")
-    PREF_KEY_ADD_SRC_NAME   = "{}{}".format(PREFS_PREFIX, "add_src_name")
-    PREF_KEY_KEEP_HEADING   = "{}{}".format(PREFS_PREFIX, "keep_heading")
-    PREF_KEY_KEEP_UNUSED    = "{}{}".format(PREFS_PREFIX, "keep_unused")
-    PREF_KEY_REM_BLANK_COLS = "{}{}".format(PREFS_PREFIX, "rem_blank_cols")
+    PREF_KEY_ADD_SRC_COLUMN = "DeleteROI.add_src_column"
+    PREF_KEY_ADD_SRC_NAME   = "DeleteROI.add_src_name"
+    PREF_KEY_KEEP_HEADING   = "DeleteROI.keep_heading"
+    PREF_KEY_KEEP_UNUSED    = "DeleteROI.keep_unused"
+    PREF_KEY_REM_BLANK_COLS = "DeleteROI.rem_blank_cols"
+    
+    # The persisted preferences: (key, attribute, cast applied to the loaded value or None)
+    PREF_SPEC = [
+        (PREF_KEY_ADJUST_TYPE,    'adjust_type',    int),
+        (PREF_KEY_BUFFER_PERCENT, 'buffer_percent', int),
+        (PREF_KEY_BC_CHANNEL_1,   'bc_channel_1',   None),
+        (PREF_KEY_BC_CHANNEL_2,   'bc_channel_2',   None),
+        (PREF_KEY_BC_CHANNEL_3,   'bc_channel_3',   None),
+        (PREF_KEY_C1_SAT,         'c1_sat',         float),
+        (PREF_KEY_C2_SAT,         'c2_sat',         float),
+        (PREF_KEY_C3_SAT,         'c3_sat',         float),
+        (PREF_KEY_DEBUG,          'debug',          bool),
+        (PREF_KEY_NUM_THREADS,    'num_threads',    int),
+        (PREF_KEY_ROI_SIZE,       'roi_size',       int),
+        (PREF_KEY_SCALE,          'scale',          int),
+        (PREF_KEY_SRC_FOLDER,     'src_folder',     None),
+        
+        (PREF_KEY_ADD_SRC_COLUMN, 'add_src_column', int),
+        (PREF_KEY_ADD_SRC_NAME,   'add_src_name',   bool),
+        (PREF_KEY_KEEP_HEADING,   'keep_heading',   bool),
+        (PREF_KEY_KEEP_UNUSED,    'keep_unused',    bool),
+        (PREF_KEY_REM_BLANK_COLS, 'rem_blank_cols', bool),
+    ]
     
     # Values read from UI - initialize to default values.  We expect direct access to these values
     TYPE_ADJUST_MIN_MAX     = 1
@@ -77,6 +117,9 @@ class Options:
     ROI_SIZE    = [ 32, 64, 128, 256 ]
     SCALES      = [ "1x", "2x", "3x" ]
     
+    # Reverse mapping from a ROI_SIZE value to its index
+    ROI_SIZE_INDEX = dict((size, index) for index, size in enumerate(ROI_SIZE))
+    
     # Constructor
     def __init__(self):
         #
@@ -85,10 +128,12 @@ class Options:
         self.bc_channel_1   = "0,600"      # Decimal value for min/max brightness/contrast - channel 1
         self.bc_channel_2   = "5000,30000" # Decimal value for min/max brightness/contrast - channel 2
         self.bc_channel_3   = "5000,30000" # Decimal value for min/max brightness/contrast - channel 3
+        self.bc_parsed      = {}           # Parsed (value, min, max) for each channel, refreshed when the value changes
         self.c1_sat         = 0.2
         self.c2_sat         = 0.2
         self.c3_sat         = 0.3
         self.debug          = False
+        self.num_threads    = 0            # Threads used to build montages, zero uses all available processors
         self.roi_size       = 64           # Size of ROI edge (square), adjust for different resolutions
         self.scale          = 2            # The scale multiplier for montage images (i.e., if size is 64 display xScale)
         self.src_folder     = ""
@@ -103,36 +148,55 @@ class Options:
         self.keep_unused    = True         # Should we keep the non-results sections?
         self.rem_blank_cols = False        # Remove blank columns from results
         
-        # Load the prefererences
-        self.loadPrefs()
+        # Load the prefererences in the background so the Java side work overlaps plugin startup.  Anything
+        # reading the options must call waitForPrefs() first.
+        self.prefs_loaded   = False
+        self.saved_prefs    = None         # The preference values as last loaded or saved, None if unknown
+        self.prefs_loader   = threading.Thread(target=self.loadPrefs, name="DeleteROI-prefs")
+        self.prefs_loader.setDaemon(True)
+        self.prefs_loader.start()
+    
+    # Wait for the background preference load started by the constructor to complete
+    def waitForPrefs(self):
+        #
+        loader = self.prefs_loader
+        if loader is not None:
+            loader.join()
+            self.prefs_loader = None
+    
+    # Convert the value using the supplied cast, values already of that type (or no cast) are used as is
+    @staticmethod
+    def coerce(value, cast):
+        #
+        if cast is None or type(value) is cast:
+            return value
+            
+        return cast(value)
     
     # Setter methods
     def setAdjustType(self, adjust_type):
-        print("OPTIONS: setting adjust_type (%) to: {}".format(adjust_type))
-        self.adjust_type = int(adjust_type)
+        if self.debug:
+            print("OPTIONS: setting adjust_type (%) to: {}".format(adjust_type))
+        self.adjust_type = Options.coerce(adjust_type, int)
         
     def setBufferPercent(self, buffer_percent):
-        print("OPTIONS: setting buffer_percent (%) to: {}".format(buffer_percent))
-        self.buffer_percent = float(buffer_percent)
+        if self.debug:
+            print("OPTIONS: setting buffer_percent (%) to: {}".format(buffer_percent))
+        self.buffer_percent = Options.coerce(buffer_percent, float)
     
     # Sets the current ROI_SIZE to the specified value after validating 
     def setRoiSize(self, size):
-        print("OPTIONS: setting roi_size to: {}".format(size))
+        if self.debug:
+            print("OPTIONS: setting roi_size to: {}".format(size))
         
         # Ensure it is an int value
-        size = int(size)
+        size = Options.coerce(size, int)
         
         # Validate it is a valid value
-        valid = False
-        for r in self.ROI_SIZE:
-            if r == size:
-                valid = True
-                break
-                
-        if not valid:
+        if size not in self.ROI_SIZE_INDEX:
             raise AssertionError("Attempt to set roi_size to invalid value: {}".format(size))
             
-        self.roi_size = int(size)
+        self.roi_size = size
 
     # Returns the ROI_SIZE value corresponding to the specified index.  If no index supplied, return current value
     def getRoiSizeValueByIndex(self, index=None):
@@ -153,30 +217,40 @@ class Options:
         if value is None:
             value = self.roi_size
         
-        index = -1
-        for r in range(0, len(self.ROI_SIZE)):
-            if value == self.ROI_SIZE[r]:
-                index = r
-                break
-                        
-        return index
+        return self.ROI_SIZE_INDEX.get(value, -1)
     
     # TODO: store the string value not the index like we do for roi_size
     def setScale(self, scale):
         # Ensure we don't have a float, etc.
-        scale = int(scale)
-        print("OPTIONS: setting scale to: {}".format(scale))
+        scale = Options.coerce(scale, int)
+        if self.debug:
+            print("OPTIONS: setting scale to: {}".format(scale))
         self.scale = scale
     
     # Retrieve the Brightness/Contrast min value for the specified channel
     def getBcMin(self, channel):
         #
-        return int(self.getChannel(channel).split(',')[0])
+        return self.getBcParsed(channel)[1]
         
     # Retrieve the Brightness/Contrast max value for the specified channel
     def getBcMax(self, channel):
         #
-        return int(self.getChannel(channel).split(',')[1])
+        return self.getBcParsed(channel)[2]
+    
+    # Returns the (value, min, max) for the specified channel.  The channel values may be assigned
+    # directly, so the cached entry is only used while it matches the current value.
+    def getBcParsed(self, channel):
+        #
+        value  = self.getChannel(channel)
+        parsed = self.bc_parsed.get(channel)
+        
+        if parsed is None or parsed[0] != value:
+            values = value.split(',')
+            parsed = (value, int(values[0]), int(values[1]))
+            
+            self.bc_parsed[channel] = parsed
+            
+        return parsed
     
     def getChannel(self, channel):
         #
@@ -194,7 +268,8 @@ class Options:
         #
         value = "{},{}".format(int(bc_min), int(bc_max))
 
-        print("OPTIONS: setting Min/Max for channel {} to: {}".format(channel, value))
+        if self.debug:
+            print("OPTIONS: setting Min/Max for channel {} to: {}".format(channel, value))
 
         if channel == 1:
             self.bc_channel_1 = value
@@ -206,42 +281,74 @@ class Options:
             print("ERROR setBcMinMax: invalid channel number: "+str(channel))
             
     def setSaturation(self, c1, c2, c3):
-        print("OPTIONS: setting saturation to: {}, {}, {}".format(c1, c2, c3))
-        self.c1_sat = float(c1)
-        self.c2_sat = float(c2)
-        self.c3_sat = float(c3)
+        if self.debug:
+            print("OPTIONS: setting saturation to: {}, {}, {}".format(c1, c2, c3))
+        self.c1_sat = Options.coerce(c1, float)
+        self.c2_sat = Options.coerce(c2, float)
+        self.c3_sat = Options.coerce(c3, float)
         
     def setDebug(self, debug):
-        print("OPTIONS: setting debug to: {}".format(debug))
-        self.debug  = bool(debug)
+        if self.debug:
+            print("OPTIONS: setting debug to: {}".format(debug))
+        self.debug  = Options.coerce(debug, bool)
+        
+    def setNumThreads(self, num_threads=0):
+        if self.debug:
+            print("OPTIONS: setting num_threads to: {}".format(num_threads))
+        self.num_threads = Options.coerce(num_threads, int)
+        
+    # Returns the number of threads to use, resolving zero (the default) to the number of processors
+    def getNumThreads(self):
+        #
+        if self.num_threads > 0:
+            return self.num_threads
+        
+        return Runtime.getRuntime().availableProcessors()
         
     def setSrcFolder(self, src_folder):
-        print("OPTIONS: setting src_folder to: {}".format(src_folder))
+        if self.debug:
+            print("OPTIONS: setting src_folder to: {}".format(src_folder))
         self.src_folder = src_folder
     
     def setTrace(self, setting=False):
-        print("OPTIONS: setting trace to: {}".format(setting))
-        self.trace = bool(setting)
+        if self.debug:
+            print("OPTIONS: setting trace to: {}".format(setting))
+        self.trace = setting
+    
+    # The trace setting is stored in the module level TRACE_ENABLED flag that trace() checks
+    @property
+    def trace(self):
+        return TRACE_ENABLED
+        
+    @trace.setter
+    def trace(self, setting):
+        global TRACE_ENABLED
+        TRACE_ENABLED = bool(setting)
     
     def setAddSrcColumn(self, column_num=1):
-        print("OPTIONS: setting add_src_column to: {}".format(column_num))
-        self.add_src_column = int(column_num)
+        if self.debug:
+            print("OPTIONS: setting add_src_column to: {}".format(column_num))
+        self.add_src_column = Options.coerce(column_num, int)
         
     def setAddSrcName(self, add_src_name=False):
-        print("OPTIONS: setting add_src_name to: {}".format(add_src_name))
-        self.add_src_name = bool(add_src_name)
+        if self.debug:
+            print("OPTIONS: setting add_src_name to: {}".format(add_src_name))
+        self.add_src_name = Options.coerce(add_src_name, bool)
         
     def setKeepHeading(self, keep=True):
-        print("OPTIONS: setting keep_heading to: {}".format(keep))
-        self.keep_heading = bool(keep)
+        if self.debug:
+            print("OPTIONS: setting keep_heading to: {}".format(keep))
+        self.keep_heading = Options.coerce(keep, bool)
         
     def setKeepUnused(self, keep_unused=True):
-        print("OPTIONS: setting keep_unused to: {}".format(keep_unused))
-        self.keep_unused = bool(keep_unused)
+        if self.debug:
+            print("OPTIONS: setting keep_unused to: {}".format(keep_unused))
+        self.keep_unused = Options.coerce(keep_unused, bool)
         
     def setRemBlankCols(self, rem_blank_cols=False):
-        print("OPTIONS: setting add_src_column to: {}".format(rem_blank_cols))
-        self.rem_blank_cols = bool(rem_blank_cols)
+        if self.debug:
+            print("OPTIONS: setting add_src_column to: {}".format(rem_blank_cols))
+        self.rem_blank_cols = Options.coerce(rem_blank_cols, bool)
         
     # Helper method to validate min/max formatting is correct.  This is essentially a kludge
     # to minimize the number of fields.
@@ -256,24 +363,10 @@ class Options:
             prefs = Prefs()
             error = prefs.load(IJ, None)
             if error is None:
-                self.adjust_type    = int(self.loadSinglePref(prefs,   Options.PREF_KEY_ADJUST_TYPE,    self.adjust_type))
-                self.buffer_percent = int(self.loadSinglePref(prefs,   Options.PREF_KEY_BUFFER_PERCENT, self.buffer_percent))
-                self.bc_channel_1   = self.loadSinglePref(prefs,       Options.PREF_KEY_BC_CHANNEL_1,   self.bc_channel_1)
-                self.bc_channel_2   = self.loadSinglePref(prefs,       Options.PREF_KEY_BC_CHANNEL_2,   self.bc_channel_2)
-                self.bc_channel_3   = self.loadSinglePref(prefs,       Options.PREF_KEY_BC_CHANNEL_3,   self.bc_channel_3)
-                self.c1_sat         = float(self.loadSinglePref(prefs, Options.PREF_KEY_C1_SAT,         self.c1_sat))
-                self.c2_sat         = float(self.loadSinglePref(prefs, Options.PREF_KEY_C2_SAT,         self.c2_sat))
-                self.c3_sat         = float(self.loadSinglePref(prefs, Options.PREF_KEY_C3_SAT,         self.c3_sat))
-                self.debug          = bool(self.loadSinglePref(prefs,  Options.PREF_KEY_DEBUG,          self.debug))
-                self.roi_size       = int(self.loadSinglePref(prefs,   Options.PREF_KEY_ROI_SIZE,       self.roi_size))
-                self.scale          = int(self.loadSinglePref(prefs,   Options.PREF_KEY_SCALE,          self.scale))
-                self.src_folder     = self.loadSinglePref(prefs,       Options.PREF_KEY_SRC_FOLDER,     self.src_folder)
-                
-                self.add_src_column = int(self.loadSinglePref(prefs,   Options.PREF_KEY_ADD_SRC_COLUMN, self.add_src_column))
-                self.add_src_name   = bool(self.loadSinglePref(prefs,  Options.PREF_KEY_ADD_SRC_NAME,   self.add_src_name))
-                self.keep_heading   = bool(self.loadSinglePref(prefs,  Options.PREF_KEY_KEEP_HEADING,   self.keep_heading))
-                self.keep_unused    = bool(self.loadSinglePref(prefs,  Options.PREF_KEY_KEEP_UNUSED,    self.keep_unused))
-                self.rem_blank_cols = bool(self.loadSinglePref(prefs,  Options.PREF_KEY_REM_BLANK_COLS, self.rem_blank_cols))
+                for key, attr, cast in Options.PREF_SPEC:
+                    value = prefs.get(key, getattr(self, attr))
+                    setattr(self, attr, Options.coerce(value, cast))
+                self.saved_prefs = self.getPrefValues()
             else:
                 print("ERROR: Unable to load preferences: "+str(error))
                 
@@ -281,55 +374,37 @@ class Options:
         except BaseException as e:
             print("OPTIONS: ERROR - unable to load preferences: "+str(e))
             print(traceback.format_exc())
+        finally:
+            self.prefs_loaded = True
         
     def savePrefs(self):
         #
+        self.waitForPrefs()
+        
+        # Nothing to write if the values are unchanged since they were last loaded or saved
+        values = self.getPrefValues()
+        if values == self.saved_prefs:
+            return
+        
         try:
             prefs = Prefs()
             
-            self.saveSinglePref(prefs, Options.PREF_KEY_ADJUST_TYPE,     self.adjust_type)
-            self.saveSinglePref(prefs, Options.PREF_KEY_BUFFER_PERCENT,  self.buffer_percent)
-            self.saveSinglePref(prefs, Options.PREF_KEY_BC_CHANNEL_1,    self.bc_channel_1)
-            self.saveSinglePref(prefs, Options.PREF_KEY_BC_CHANNEL_2,    self.bc_channel_2)
-            self.saveSinglePref(prefs, Options.PREF_KEY_BC_CHANNEL_3,    self.bc_channel_3)
-            self.saveSinglePref(prefs, Options.PREF_KEY_C1_SAT,          self.c1_sat)
-            self.saveSinglePref(prefs, Options.PREF_KEY_C2_SAT,          self.c2_sat)
-            self.saveSinglePref(prefs, Options.PREF_KEY_C3_SAT,          self.c3_sat)
-            self.saveSinglePref(prefs, Options.PREF_KEY_DEBUG,           self.debug)
-            self.saveSinglePref(prefs, Options.PREF_KEY_ROI_SIZE,        self.roi_size)
-            self.saveSinglePref(prefs, Options.PREF_KEY_SCALE,           self.scale)
-            self.saveSinglePref(prefs, Options.PREF_KEY_SRC_FOLDER,      self.src_folder)
-            
-            self.saveSinglePref(prefs, Options.PREF_KEY_ADD_SRC_COLUMN,  self.add_src_column)
-            self.saveSinglePref(prefs, Options.PREF_KEY_ADD_SRC_NAME,    self.add_src_name)
-            self.saveSinglePref(prefs, Options.PREF_KEY_KEEP_HEADING,    self.keep_heading)
-            self.saveSinglePref(prefs, Options.PREF_KEY_KEEP_UNUSED,     self.keep_unused)
-            self.saveSinglePref(prefs, Options.PREF_KEY_REM_BLANK_COLS,  self.rem_blank_cols)
+            for (key, attr, cast), value in zip(Options.PREF_SPEC, values):
+                prefs.set(key, value)
             
             prefs.savePreferences()
+            self.saved_prefs = values
         except BaseException as e:
             print("OPTIONS: ERROR - unable to save preferences: "+str(e))
-        
-    def loadSinglePref(self, prefs, key, default):
-        #
-        try:
-            return prefs.get(key, default)
-        except BaseException as e:
-            print("Prefs: Exception load pref ({}) using default {}".format(key, default))
-            #print(traceback.format_exc())
-            
-        return default
-
-    def saveSinglePref(self, prefs, key, value):
+    
+    # The current value of each preference, in PREF_SPEC order
+    def getPrefValues(self):
         #
-        try:
-            prefs.set(key, value)
-        except BaseException as e:
-            print("Prefs: Exception saving pref ({}) = {}: {}".format(key, value))
+        return tuple([getattr(self, attr) for key, attr, cast in Options.PREF_SPEC])
     
     # Debugging information
     def __str__(self):
-        return "OPTIONS: adjust_type={}, buffer_percent={}, scale={}, bc_c1={}, bc_c2={}, bc_c2={}, c1={}, c2={}, c3={}, roi_size={}, debug={}, src_folder={}".format(self.adjust_type, \
+        return "OPTIONS: adjust_type=%s, buffer_percent=%s, scale=%s, bc_c1=%s, bc_c2=%s, bc_c2=%s, c1=%s, c2=%s, c3=%s, roi_size=%s, debug=%s, src_folder=%s" % (self.adjust_type, \
                 self.buffer_percent, self.scale, self.bc_channel_1, self.bc_channel_2, self.bc_channel_3, self.c1_sat, self.c2_sat, self.c3_sat, self.roi_size, self.debug, self.src_folder)
 
 # Helper class to format numbers
@@ -398,7 +473,7 @@ def addItemToList(target, index, item):
     # Indexes are zero offset so len must always be one more than index
     if index >= len(target):
         # Array is not large enough, enlarge it
-        target.append([0] * (len(target) - index))
+        target.extend([None] * (index - len(target) + 1))
    
     target[index] = item
 
@@ -411,17 +486,57 @@ def convertToFloat(value, default):
         trace("conversion of '{}' to float failed, using default value: {}".format(value, default))
         return default
 
-# Helper method for debug printout
-def trace(message):
+# Determine if a directory has no entries.  This stops at the first entry rather than listing
+# the entire directory like os.listdir() would.
+def is_directory_empty(path):
+    #
+    stream = Files.newDirectoryStream(Paths.get(path))
+    try:
+        return not stream.iterator().hasNext()
+    finally:
+        stream.close()
+
+# Helper method for debug printout.  If args are supplied the message is treated as a format
+# string and only formatted when tracing is enabled, use this form in loops.
+def trace(message, *args):
     #
-    if OPTIONS.trace:
+    if TRACE_ENABLED:
+        if args:
+            message = message.format(*args)
+        flush_log()
         print("DBG: "+str(message))
 
+# Buffered progress messages.  Lines are collected and printed together every LOG_FLUSH_EVERY lines
+# (or by flush_log()) so the console is updated once rather than for every line.  Use it for batches of
+# non-interactive output, trace() flushes it first so the output stays in order.
+def log(message):
+    #
+    global LOG_PENDING
+    with LOG_LOCK:
+        LOG_BUFFER.append(str(message)).append("\n")
+        LOG_PENDING += 1
+        if LOG_PENDING >= LOG_FLUSH_EVERY:
+            flush_log()
+
+# Print any buffered log lines
+def flush_log():
+    #
+    global LOG_PENDING
+    with LOG_LOCK:
+        if LOG_PENDING > 0:
+            LOG_BUFFER.setLength(LOG_BUFFER.length() - 1)
+            print(LOG_BUFFER.toString())
+            LOG_BUFFER.setLength(0)
+            LOG_PENDING = 0
+
 # Function to close all images and ROIs
 def close_all():
     #
-    # Garbage cleanup
+    # Garbage cleanup, nothing to do (or dispatch) when no images are open
     #
+    if WindowManager.getImageCount() == 0:
+        return
+    
     IJ.run("Close All")
 
 #
@@ -20,39 +20,45 @@
  * ===============================================================================
 '''
 
-# Standard Python imports
-import imp, os, sys
-
-# GUI Imports
-from ij.plugin.frame        import RoiManager
-
-# Our package imports
-from DeleteROIPkg.Bundles   import BundleManager
-from DeleteROIPkg.Dialogs   import SelectFilesDialog, ProcessFilesDialog, show_error
-from DeleteROIPkg.Session   import SessionManager
-from DeleteROIPkg.Slides    import SlideManager
-from DeleteROIPkg.Utilities import close_all, trace
+# Our package imports, the remaining (heavier) imports are done by main() when the plugin is run
+from DeleteROIPkg.Utilities import close_all, flush_log, log, trace
 from DeleteROIPkg.Utilities import parm_columns, parm_max_rows
 from DeleteROIPkg.Utilities import OPTIONS
 
 # Constants 
 VERSION = "1.0.3-2"
+BANNER  = "DeleteRoi: version " + VERSION + " loaded and started"
+TITLE   = "DeleteROI File Selector   - DeleteROI v" + VERSION     # Title of the SelectFilesDialog
 
 # https://imagej.net/scripting/jython/
 
 # Main function to run the process
 def main():
     #
+    # Imports are deferred until we run to keep loading the package (i.e., plugin discovery) cheap
+    from java.util.concurrent   import Executors
+    
+    from ij                     import IJ
+    from ij.plugin.frame        import RoiManager
+    
+    from DeleteROIPkg.Bundles   import BundleManager
+    from DeleteROIPkg.Dialogs   import SelectFilesDialog, ProcessFilesDialog, show_error
+    from DeleteROIPkg.Session   import SessionManager, SessionPrefetcher
+    from DeleteROIPkg.Slides    import SlideManager
+    
     # Ensure all images are closed
     close_all()
     
-    print("DeleteRoi: version {} loaded and started".format(VERSION))
+    print(BANNER)
     
     # Just in case, setup the ROI Manager now
     roi_manager = RoiManager.getInstance()
     if roi_manager is None:
         roi_manager = RoiManager()
         
+    # The preferences are loaded in the background, they must be available before the dialogs are shown
+    OPTIONS.waitForPrefs()
+    
     # Create the BundleManager to manage the bundles created by the Dialog
     bundle_mgr  = BundleManager()
     slide_mgr   = SlideManager()
@@ -62,11 +68,8 @@ def main():
     result      = ""
     
     try:
-    	# Define the title of the SelectFilesDialog to include the version number
-    	title = "DeleteROI File Selector   - DeleteROI v{}".format(VERSION)
-    	
         # Prompt the user for the bundles to the processed.
-        select_files = SelectFilesDialog(title, session_mgr, bundle_mgr, slide_mgr)
+        select_files = SelectFilesDialog(TITLE, session_mgr, bundle_mgr, slide_mgr)
         status, restored = select_files.execute()
         
         # Save any preferences
@@ -84,18 +87,53 @@ def main():
         OPTIONS.savePrefs()
 
         # Now iterate through the sessions, processing each as a montage.  At the
-        # end of each session being process state is saved to enable restart.
-        for session in session_mgr:
-            #
-            if session.is_complete():
-                print("Skipping session due to being complete: "+str(session))
-                continue
+        # end of each session being process state is saved to enable restart.  While
+        # a session is being worked on the images of the next session are opened in
+        # the background.  Everything started from here on is cleaned up by the finally.
+        loader      = Executors.newFixedThreadPool(min(4, OPTIONS.getNumThreads()))
+        prefetcher  = None
+        roi_visible = None
+        try:
+            prefetcher = SessionPrefetcher(list(session_mgr.incomplete_sessions()), loader)
+            
+            num_skipped = session_mgr.get_session_count() - len(prefetcher.sessions)
+            if num_skipped > 0:
+                print("Skipping {} session(s) due to being complete".format(num_skipped))
+            
+            # The session state is written in the background so the next session isn't held up
+            session_mgr.start_background_saves()
             
-            session.process(parm_columns, OPTIONS.roi_size, parm_max_rows)
-            #
-            print("Session completed: "+str(session))
-            #
-            session_mgr.save_session_state()
+            # Hide the ROI Manager while the sessions are processed, each ROI added to a visible
+            # list is repainted individually on the event thread.
+            roi_visible = roi_manager.isVisible()
+            roi_manager.runCommand("Deselect")
+            roi_manager.setVisible(False)
+            
+            # The montage layout doesn't change while the sessions are processed
+            columns  = parm_columns
+            roi_size = OPTIONS.roi_size
+            max_rows = parm_max_rows
+            total    = len(prefetcher.sessions)
+            
+            prefetcher.start()
+            for index, session in enumerate(prefetcher):
+                #
+                session.process(columns, roi_size, max_rows)
+                #
+                IJ.showProgress(index + 1, total)
+                log("Session completed: "+str(session))
+                flush_log()
+                #
+                session_mgr.append_session_delta(session)
+        finally:
+            flush_log()
+            if prefetcher is not None:
+                prefetcher.stop()
+            loader.shutdownNow()
+            if roi_visible is not None:
+                roi_manager.setVisible(roi_visible)
+            session_mgr.checkpoint_session_state()
+            session_mgr.stop_background_saves()
             
         # Indicate final result
         num_sessions  = session_mgr.get_session_count()
@@ -108,16 +146,13 @@ def main():
         result = "Processing cancelled, {} out of {} sessions were completed and have been saved".format(num_completed, num_sessions)
         print("*** Exception: "+str(e))
     
-    # Close everything before we display complete message
-    close_all()
+    finally:
+        # Close everything before we display complete message and save any preferences, this is
+        # done however processing ended.
+        close_all()
+        OPTIONS.savePrefs()
     
     # Give a status message indicating that we are complete
     show_error("All processing complete", result)
 
     print("All Processing Complete")
-    
-    # Just in case
-    close_all()
-
-    # Save any preferences - just in case
-    OPTIONS.savePrefs()